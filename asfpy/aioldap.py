@@ -21,9 +21,19 @@
 #
 # ### TBD. look at code for now.
 #
+# Requires bonsai 1.1 or newer (for set_connect_async). Connections are
+# opened in executor threads, then moved to the caller's loop through
+# bonsai's private AIOLDAPConnection._loop attribute, which is present
+# in bonsai 1.1 through 1.5.5 (see ASF_LDAPConnection.__init__).
+#
 
+import os
 import asyncio
 import logging
+import socket
+import threading
+import functools
+import contextvars
 import concurrent.futures
 
 import bonsai
@@ -35,21 +45,82 @@ from bonsai import LDAPSearchScope as SCOPE
 
 LOGGER = logging.getLogger(__name__)
 
+# Seconds to wait for a connection (and its bind) to complete.
+DEFAULT_CONNECT_TIMEOUT = 10
+
+# Connecting is blocking, and performed within executor threads. Bound
+# the number of those threads, rather than letting them grow with load.
+MAX_CONNECT_WORKERS = min(32, (os.cpu_count() or 1) * 2)
+
+# Each executor thread holds its own loop, to use for connecting.
+_THREAD_STATE = threading.local()
+
+# The caller's loop, and the connect timeout, for the connection being
+# constructed (see _new_connection).
+_CONNECT_TARGET = contextvars.ContextVar('aioldap_connect_target')
+
+
+def _new_connect_loop():
+    "Executor initializer: construct the loop for the current thread."
+    _THREAD_STATE.loop = asyncio.new_event_loop()
+
+# All clients share one executor (and its threads), created on demand.
+_SHARED_EXECUTOR = None
+_SHARED_EXECUTOR_LOCK = threading.Lock()
+
+
+def shared_executor():
+    "Return the executor used by all clients for connecting."
+    global _SHARED_EXECUTOR  # pylint: disable=global-statement
+    with _SHARED_EXECUTOR_LOCK:
+        if _SHARED_EXECUTOR is None:
+            _SHARED_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+                max_workers=MAX_CONNECT_WORKERS,
+                thread_name_prefix='aioldap',
+                initializer=_new_connect_loop)
+        return _SHARED_EXECUTOR
+
 
 class ASF_LDAPConnection:
+
+    # Socket options applied to the LDAP connection. Pooled connections
+    # sit idle for long periods, and NAT/firewalls will silently drop
+    # them; TCP keepalives keep those flows alive, and detect dead peers.
+    # Ops can tune these on the class (or a subclass).
+    TCP_SOCKET_OPTIONS = [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+    if hasattr(socket, 'TCP_KEEPIDLE'):  # Linux-specific
+        TCP_SOCKET_OPTIONS += [
+            (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 45),
+            (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 20),
+            (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5),
+        ]
+    if hasattr(socket, 'TCP_USER_TIMEOUT'):  # Linux-specific
+        # Milliseconds for unacknowledged data, matching the keepalives.
+        TCP_SOCKET_OPTIONS += [
+            (socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, (45 + 20 * 5) * 1000),
+        ]
+
     def __init__(self, client, executor):
-        # NOTE: must be instantiated within one of the EXECUTOR threads.
+        # NOTE: must be instantiated within one of the EXECUTOR threads,
+        # by ASF_LDAPClient (see _new_connection).
 
         # Shared Executor holding one or more threads.
         self.executor = executor
 
-        # bonsai.LDAPConnection ties itself to a loop. Thus, whatever
-        # loop is used to create the connection must also be used to
-        # perform its operations. We will construct that loop here,
-        # and use it for all bonsai actions. It does not have any
-        # thread affinity, until it is running. Thus, we can use this
-        # loop within any thread of the Executor.
-        self.loop = asyncio.new_event_loop()
+        # The pool of the ASF_LDAPClient which opened this connection.
+        self.pool = None
+
+        loop, timeout = _CONNECT_TARGET.get()
+
+        # bonsai.LDAPConnection ties itself to a loop. The connection
+        # must be established in a loop running in THIS thread (see the
+        # GnuTLS hack below), so we use the thread's private loop for
+        # the connect/bind. Afterwards, the connection is re-bound to
+        # LOOP (the caller's loop) and all operations run directly in
+        # that loop, without any trips through the Executor.
+        connect_loop = _THREAD_STATE.loop
 
         # Hack around GnuTLS bug with async.
         # See: https://github.com/noirello/bonsai/issues/25
@@ -65,42 +136,66 @@ class ASF_LDAPConnection:
             # Tell bonsai to connect synchronously.
             bonsai.set_connect_async(False)
             try:
-                # Ties to self.loop (the running loop now).
-                return await client.connect(is_async=True)
+                # Ties to connect_loop (the running loop now).
+                # Note: the synchronous part of the connect cannot be
+                # interrupted by wait_for(), so give bonsai the TIMEOUT.
+                return await client.connect(is_async=True, timeout=timeout)
             finally:
                 # Make sure this always gets reset.
                 bonsai.set_connect_async(True)
 
-        # The underlying LDAP connection, tied to our loop.
-        self.conn = self.loop.run_until_complete(do_connect())
+        # Never hold onto this executor thread indefinitely, if the
+        # server is unreachable.
+        try:
+            self.conn = connect_loop.run_until_complete(
+                asyncio.wait_for(do_connect(), timeout))
+        except (asyncio.TimeoutError, bonsai.errors.TimeoutError) as e:
+            raise bonsai.errors.ConnectionError(
+                f'Connection timed out after {timeout} seconds') from e
+
+        try:
+            self.set_socket_options()
+        except BaseException:
+            self.conn.close()
+            raise
+
+        # The connect/bind is complete, and no callbacks remain on the
+        # thread's loop. Hand the underlying LDAP connection over to
+        # the caller's loop, where bonsai will perform its async I/O.
+        # bonsai has no public way to do this: its AIOLDAPConnection
+        # runs all I/O through the private _loop attribute. Fail clearly
+        # if a bonsai release changes that.
+        if not hasattr(self.conn, '_loop'):
+            self.conn.close()
+            raise RuntimeError(f'bonsai {bonsai.__version__} is not supported:'
+                               f' its connections have no _loop attribute')
+        self.conn._loop = loop  # pylint: disable=protected-access
+
+    def set_socket_options(self):
+        "Apply TCP_SOCKET_OPTIONS to the connection's socket, if it is TCP."
+        # Note: the descriptor is duplicated. Options set on the duplicate
+        # apply to the (shared) underlying socket. The family is detected
+        # from the descriptor: ldapi:// connects over a Unix socket.
+        with socket.socket(fileno=os.dup(self.conn.fileno())) as sock:
+            if sock.family not in (socket.AF_INET, socket.AF_INET6):
+                return
+            for level, option, value in self.TCP_SOCKET_OPTIONS:
+                sock.setsockopt(level, option, value)
 
     def close(self):
         self.conn.close()
         self.conn = None  # ensure self is unusable
 
-    async def use_loop(self, loop, method, *args, **kw):
-        "Running in LOOP, run/wait for METHOD with *ARGS and **KW."
-        if loop is None:
-            loop = asyncio.get_running_loop()
-
-        def call_method():
-            # This synchronous function is now running within a thread
-            # of the Executor. Use some async to run the LDAP connection's
-            # method within our loop.
-            return self.loop.run_until_complete(method(*args, **kw))
-
-        # Wait within the caller's loop for the result.
-        return await loop.run_in_executor(self.executor, call_method)
+    # Note: LOOP is accepted for backwards compatibility, but is ignored.
+    # These must be awaited within the loop given to ASF_LDAPClient.connect()
 
-    async def search(self, base, attrs, scope=SCOPE.SUBTREE, loop=None):
-        return await self.use_loop(loop,
-                                   self.conn.search,
-                                   base,
-                                   scope,
-                                   attrlist=attrs)
+    async def search(self, base, attrs, scope=SCOPE.SUBTREE, loop=None,  # pylint: disable=unused-argument
+                     filter_exp=None):
+        return await self.conn.search(base, scope, filter_exp,
+                                      attrlist=attrs)
 
-    async def whoami(self, loop=None):
-        return await self.use_loop(loop, self.conn.whoami)
+    async def whoami(self, loop=None):  # pylint: disable=unused-argument
+        return await self.conn.whoami()
 
     ### TBD ASF-specific custom methods? or use app-specific subclasses?
 
@@ -109,47 +204,214 @@ class ASF_LDAPClient:
 
     CONNECTION_CLASS = ASF_LDAPConnection
 
-    def __init__(self, uri, binddn, bindpw):
+    # Idle connections in the pool are pinged with a (cheap) whoami
+    # this often, to keep them alive and to weed out dead connections.
+    KEEPALIVE_INTERVAL = 60  # seconds
+
+    def __init__(self, uri, binddn, bindpw, minconn=2, maxconn=16,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        assert 0 <= minconn <= maxconn, 'MINCONN must be within 0..MAXCONN'
+
         self.client = bonsai.LDAPClient(uri)
         self.client.set_credentials("SIMPLE", binddn, bindpw)
         self.client.set_cert_policy("allow")  # TODO: Load our cert(?)
 
-        self.executor = concurrent.futures.ThreadPoolExecutor(
-            thread_name_prefix='aioldap')
+        self.executor = shared_executor()
+
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.connect_timeout = connect_timeout
+
+        # Idle connections are kept in this queue. Each connection is
+        # bound to a loop, so the pool is constructed upon the first
+        # call to connect(), and tied to that caller's loop. A connect()
+        # from another loop replaces the pool.
+        self._pool = None
+        self._loop = None
+        self._keepalive_task = None
+
+        # Limits the connections in use to MAXCONN. Released (waking a
+        # waiting acquire) as each is returned to the pool, or dropped.
+        self._slots = None
+
+        # Number of connections opened for the pool (idle, in-use, or
+        # in the process of being opened).
+        self._opened = 0
 
     def connect(self, loop=None):
         if loop is None:
             loop = asyncio.get_running_loop()
+        return ConnectContextManager(self, loop)
 
-        # Run (blocking) in an executor thread.
-        def blocking_connect():
-            return self.CONNECTION_CLASS(self.client, self.executor)
+    async def _open(self, loop):
+        "Open a new connection, tied to LOOP."
+
+        # Run (blocking) in an executor thread. This must be our own
+        # executor, rather than the loop's default executor (as used by
+        # asyncio.to_thread), since its threads hold the loops used for
+        # connecting. This is the only use of an executor: operations
+        # such as search and whoami run directly in the caller's loop.
+        #
+        # Unlike asyncio.to_thread(), submit() does not carry the
+        # caller's context (eg. for logging) into the thread. Bind the
+        # context, class, and arguments without creating a closure.
+        blocking_connect = functools.partial(contextvars.copy_context().run,
+                                             _new_connection,
+                                             self.CONNECTION_CLASS,
+                                             self.client, self.executor,
+                                             loop, self.connect_timeout)
+
+        pool = self._pool
+        self._opened += 1
+        future = self.executor.submit(blocking_connect)
+        try:
+            conn = await asyncio.wrap_future(future, loop=loop)
+        except BaseException:
+            if pool is self._pool:
+                self._opened -= 1
+            # If this task was cancelled, the thread may still complete
+            # the connection. Nobody will use it, so close it then.
+            future.add_done_callback(_close_abandoned)
+            raise
+        conn.pool = pool
+        return conn
+
+    async def acquire(self, loop):
+        "Return an idle connection from the pool, or open a new one."
+        if loop is not self._loop:
+            # Such as the first connect(), or one after a prior
+            # asyncio.run() has finished with the pool's loop.
+            self.close()
+            self._pool = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.maxconn)
+            self._loop = loop
+            self._keepalive_task = loop.create_task(self._keepalive())
+
+        # When all connections are in use, wait for one to be released.
+        await self._slots.acquire()
+        try:
+            try:
+                return self._pool.get_nowait()
+            except asyncio.QueueEmpty:
+                return await self._open(loop)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        "Return CONN to the pool, or close it if DISCARD is set."
+        if conn.pool is self._pool:
+            self._slots.release()
+        self._put(conn, discard)
+
+    def _put(self, conn, discard=False):
+        "Put CONN with the idle connections, or close it."
+        if conn.pool is not self._pool:
+            # The pool was closed (or replaced) since CONN was opened.
+            conn.close()
+        elif discard:
+            conn.close()
+            self._opened -= 1
+        else:
+            self._pool.put_nowait(conn)
+
+    def close(self):
+        "Close all idle connections. In-use connections close on release."
+        if self._pool is None:
+            return
+        # The loop may be closed, such as after asyncio.run(). It will
+        # have cancelled the task already.
+        if not self._loop.is_closed():
+            self._keepalive_task.cancel()
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+        self._pool = None
+        self._slots = None
+        self._loop = None
+        self._keepalive_task = None
+        self._opened = 0
+
+    async def _keepalive(self):
+        while True:
+            try:
+                # Keep (at least) MINCONN connections ready to go.
+                while self._opened < self.minconn:
+                    async with self._slots:
+                        conn = await self._open(self._loop)
+                    self._put(conn)
+            except bonsai.LDAPError as e:
+                LOGGER.error(f'Could not open pooled connection: {e}')
+            except asyncio.CancelledError:  # pylint: disable=try-except-raise
+                raise  # an Exception, before Python 3.8
+            except Exception:  # pylint: disable=broad-except
+                # Such as an OSError from set_socket_options(). Log it,
+                # but keep the pool going.
+                LOGGER.exception('Could not open pooled connection')
+
+            await asyncio.sleep(self.KEEPALIVE_INTERVAL)
+
+            # Ping each of the connections that are idle right now.
+            for _ in range(self._pool.qsize()):
+                conn = self._pool.get_nowait()
+                alive = False
+                try:
+                    await conn.whoami()
+                    alive = True
+                except bonsai.LDAPError as e:
+                    LOGGER.info(f'Dropping pooled connection: {e}')
+                except asyncio.CancelledError:  # pylint: disable=try-except-raise
+                    raise
+                except Exception:  # pylint: disable=broad-except
+                    LOGGER.exception('Dropping pooled connection')
+                finally:
+                    # Note: close() may cancel this task, while CONN is
+                    # out of the pool. It is closed, rather than leaked.
+                    self._put(conn, discard=not alive)
+
+def _new_connection(cls, client, executor, loop, timeout):
+    "Executor job: construct a CLS connection, to be used in LOOP."
+    # CLS keeps the (client, executor) signature of ASF_LDAPConnection,
+    # for subclasses plugged in as CONNECTION_CLASS. The rest is passed
+    # in the job's (copied) context.
+    _CONNECT_TARGET.set((loop, timeout))
+    return cls(client, executor)
+
+
+def _close_abandoned(future):
+    "Close the connection opened by FUTURE, if any. Its caller went away."
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
 
-        future = loop.run_in_executor(self.executor, blocking_connect)
-        #print('CONN-FUTURE:', future)
-        return ConnectContextManager(future)
 
 # For debugging, we want the ASF_ prefix, but callers can skip it.
 LDAPClient = ASF_LDAPClient
 
 
 class ConnectContextManager:
-    def __init__(self, future):
-        self.future = future
+    def __init__(self, client, loop):
+        self.client = client
+        self.loop = loop
 
     async def __aenter__(self):
-        self.conn = await self.future
+        self.conn = await self.client.acquire(self.loop)
         return self.conn
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        self.conn.close()
+        # Do not return a (possibly) broken connection to the pool. An
+        # interrupted operation may also have left the connection in
+        # an unknown state.
+        discard = exc_type is not None \
+            and issubclass(exc_type, (bonsai.errors.ConnectionError,
+                                      asyncio.CancelledError))
+        self.client.release(self.conn, discard)
 
 
 def test_conns(client):
     # Run three tasks in parallel: heartbeat, connA, connB. The latter
-    # two will open, run a couple LDAP queries, then close. Then re-open.
-    # These will run in one event loop (the LDAPClient has some private
-    # loops; no peeking).
+    # two will grab a connection, run a couple LDAP queries, then return
+    # it to the pool. Then grab another.
+    # These will run in one event loop (the LDAPClient uses a private
+    # loop for connecting; no peeking).
     #
     # Should see: smooth heartbeat, even when an artifical delay is
     # introduced to the connect() process.
@@ -197,7 +459,7 @@ def test_conns(client):
 
 
 if __name__ == '__main__':
-    import os, getpass
+    import getpass
     u = os.environ.get('AIOLDAP_USER') or getpass.getuser()
     dn = 'uid=%s,ou=people,dc=apache,dc=org' % u
     p = os.environ.get('AIOLDAP_PASSWORD') or getpass.getpass(f"Password for {u}: ")
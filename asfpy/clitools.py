@@ -1,13 +1,41 @@
 #!/usr/bin/env python3
+import sys
 import subprocess
 import asyncio.subprocess
-import base64
+import importlib.util
+import functools
+from base64 import b64decode as _b64decode
 
 """Python wrappers for common CLI tools"""
 
+# Maximum length of an output line read by the async wrappers. Lines are not
+# wrapped, and may hold large (base64) values, such as jpegPhoto.
+ASYNC_LINE_LIMIT = 16 * 1024 * 1024
 
-def ldapsearch_parse(indata: str):
+# Decoded base64 values are cached, as values (such as names with accents) tend to
+# repeat across many results. Longer values, like photos and password hashes, are
+# decoded each time rather than kept around.
+B64_CACHE_SIZE = 1024
+B64_CACHE_MAX_LENGTH = 64  # Of the encoded value
+
+# When bonsai is installed, the async wrapper can search through an
+# asfpy.aioldap client, rather than running asfldapsearch.
+HAVE_BONSAI = importlib.util.find_spec("bonsai") is not None
+
+# ldapsearch scopes, mapped to their bonsai.LDAPSearchScope names
+BONSAI_SCOPES = {
+    "base": "BASE",
+    "one": "ONELEVEL",
+    "sub": "SUBTREE",
+    "children": "SUBORDINATE",
+}
+
+
+def ldapsearch_parse(indata: bytes):
     """Parses ldapsearch output into structured python data"""
+    if isinstance(indata, bytes):
+        indata = indata.decode("utf-8")
+    intern = sys.intern  # Attribute names repeat for every result
     results = []
     bunch = {}
     for line in indata.splitlines(keepends=False):
@@ -15,17 +43,49 @@ def ldapsearch_parse(indata: str):
             results.append(bunch)
             bunch = {}
         else:
-            key, value = line.split(":", maxsplit=1)
-            if value.startswith(":"):  # Base64
-                value = base64.standard_b64decode(value[2:]).decode("utf-8")
+            key, sep, value = line.partition(":")
+            if not sep:
+                raise ValueError("Malformed ldapsearch output line: %r" % line)
+            key = intern(key)
+            if value[:1] == ":":  # Base64
+                encoded = value[2:]
+                if len(encoded) <= B64_CACHE_MAX_LENGTH:
+                    value = _b64decode_cached(encoded)
+                else:
+                    value = _b64decode(encoded).decode()
             else:
                 value = value.strip()
-            if key not in bunch:
-                bunch[key] = list()
-            bunch[key].append(value)
+            bunch.setdefault(key, []).append(value)
     return results  # Return the list of results
 
 
+@functools.lru_cache(maxsize=B64_CACHE_SIZE)
+def _b64decode_cached(encoded):
+    """Decodes a (short) base64 value, caching the result"""
+    return _b64decode(encoded).decode()
+
+
+def ldapsearch_iter(lines):
+    """Parses an iterable of ldapsearch output lines, yielding each result as soon as it is complete"""
+    pending = []
+    for line in lines:
+        pending.append(line)
+        if line == b"\n":  # The end of a bunch always ends with a blank line.
+            yield from ldapsearch_parse(b"".join(pending))
+            pending.clear()
+
+
+async def ldapsearch_aiter(lines):
+    """Parses an async iterable of ldapsearch output lines, yielding each result as soon as it is complete"""
+    pending = []
+    async for line in lines:
+        pending.append(line)
+        if line == b"\n":  # The end of a bunch always ends with a blank line.
+            for bunch in ldapsearch_parse(b"".join(pending)):
+                yield bunch
+            pending.clear()
+
+
 def ldapsearch_cliargs(ldap_base, ldap_scope, ldap_query, ldap_attrs, ldap_exec):
     """Constructs a list of command line arguments for asfldapsearch"""
     cliargs = [
@@ -49,6 +109,11 @@ def ldapsearch_cliargs(ldap_base, ldap_scope, ldap_query, ldap_attrs, ldap_exec)
     return cliargs
 
 
+# NOTE: each call runs a new asfldapsearch process, which performs its own
+# connect and bind. A long-lived co-process, fed queries over stdin, would
+# amortize that cost. However, (asf)ldapsearch has no batch mode which marks
+# where the output of one query ends, so results cannot be matched to their
+# queries. For repeated searches, pass an aioldap client to the async wrapper.
 def ldapsearch_cli(
     ldap_base="dc=apache,dc=org",
     ldap_scope="sub",
@@ -63,10 +128,13 @@ def ldapsearch_cli(
     :param ldap_attrs: The LDAP attribute elements to include in the result.
     """
 
-    # Run asfldapsearch tool, parse the output and return the data structure
+    # Run asfldapsearch tool, parse the output as it arrives and return the data structure
     cliargs = ldapsearch_cliargs(ldap_base, ldap_scope, ldap_query, ldap_attrs, ldap_exec)
-    output = subprocess.run(cliargs, stdout=subprocess.PIPE, check=True).stdout.decode("us-ascii")
-    return ldapsearch_parse(output)
+    with subprocess.Popen(cliargs, stdout=subprocess.PIPE) as proc:
+        results = list(ldapsearch_iter(proc.stdout))
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cliargs)
+    return results
 
 
 async def ldapsearch_cli_async(
@@ -75,16 +143,63 @@ async def ldapsearch_cli_async(
     ldap_query="*",
     ldap_attrs=("cn",),
     ldap_exec=None,
+    ldap_client=None,
 ):
     """Runs an async search in LDAP using (asf)ldapsearch and returns the results as a list of dictionaries
     :param ldap_base:  The base for the LDAP search
     :param ldap_scope: The scope of the search. Can be: base, one, sub, children.
     :param ldap_query: The LDAP query to filter by
     :param ldap_attrs: The LDAP attribute elements to include in the result.
+    :param ldap_client: Optional asfpy.aioldap.LDAPClient to search with, instead of running asfldapsearch.
     """
 
-    # Run asfldapsearch tool, parse the output and return the data structure
+    # Search directly over the client's (pooled) connection, if we can
+    if ldap_client is not None and HAVE_BONSAI:
+        return await ldapsearch_bonsai(ldap_client, ldap_base, ldap_scope, ldap_query, ldap_attrs)
+
+    # Run asfldapsearch tool, parse the output as it arrives and return the data structure
     cliargs = ldapsearch_cliargs(ldap_base, ldap_scope, ldap_query, ldap_attrs, ldap_exec)
-    proc = await asyncio.subprocess.create_subprocess_exec(cliargs[0], *cliargs[1:], stdout=asyncio.subprocess.PIPE) # pylint: disable=no-member
-    stdout, _stderr = await proc.communicate()  # "await proc.wait()" can deadlock inside async servers, so avoid using it.
-    return ldapsearch_parse(stdout.decode("us-ascii"))
+    proc = await asyncio.subprocess.create_subprocess_exec(cliargs[0], *cliargs[1:], stdout=asyncio.subprocess.PIPE, limit=ASYNC_LINE_LIMIT) # pylint: disable=no-member
+    results = [bunch async for bunch in ldapsearch_aiter(proc.stdout)]
+    await proc.wait()  # Only safe once stdout has been drained, else this can deadlock inside async servers.
+    return results
+
+
+async def ldapsearch_bonsai(
+    ldap_client,
+    ldap_base="dc=apache,dc=org",
+    ldap_scope="sub",
+    ldap_query="*",
+    ldap_attrs=("cn",),
+):
+    """Runs an async search in LDAP using an asfpy.aioldap client, and returns the results in the same form as ldapsearch_cli
+    :param ldap_client: The asfpy.aioldap.LDAPClient to search with
+    :param ldap_base:  The base for the LDAP search
+    :param ldap_scope: The scope of the search. Can be: base, one, sub, children.
+    :param ldap_query: The LDAP query to filter by
+    :param ldap_attrs: The LDAP attribute elements to include in the result.
+    """
+    import asfpy.aioldap  # Requires bonsai
+
+    scope = getattr(asfpy.aioldap.SCOPE, BONSAI_SCOPES[ldap_scope])
+    # Like ldapsearch, accept filters without the surrounding parentheses
+    if ldap_query == "*":
+        ldap_query = "(objectClass=*)"
+    elif not ldap_query.startswith("("):
+        ldap_query = "(%s)" % ldap_query
+    if isinstance(ldap_attrs, str):
+        ldap_attrs = [ldap_attrs]
+    else:
+        ldap_attrs = list(ldap_attrs)
+
+    async with ldap_client.connect() as conn:
+        entries = await conn.search(ldap_base, ldap_attrs, scope, filter_exp=ldap_query)
+
+    results = []
+    for entry in entries:
+        bunch = {"dn": [str(entry.dn)]}
+        for key, values in entry.items():
+            if key != "dn":
+                bunch[key] = [value.decode("utf-8") if isinstance(value, bytes) else str(value) for value in values]
+        results.append(bunch)
+    return results
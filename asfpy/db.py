@@ -21,25 +21,161 @@
 # This wrapper has several primary purposes:
 #
 #   1. Easily create a cursor for each statement that might be
-#      executed by the application.
+#      executed by the application (upon its first use).
 #   2. Remember the specific string object for those statements,
 #      and re-use them in cursor.execute() for better performance.
-#   3. Rows fetched with SELECT statements are wrapped into a
-#      EasyDict() instance, such that columns can be easily
+#   3. Rows fetched with SELECT statements are constructed as a
+#      Row() instance (a dict), such that columns can be easily
 #      accessed as attributes.
 #
 
 import sqlite3
+import pathlib
 import functools
+import contextlib
+import threading
+import queue
+import warnings
 
 import yaml
-import easydict
+
+# PRAGMA settings applied to each connection, unless DB() is passed
+# others. WAL journaling with NORMAL synchronization avoids an fsync per
+# (autocommit) write, and remains safe against corruption. Pass
+# pragmas={} to DB() to keep the defaults of SQLite itself.
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # negative means KiB, rather than pages
+}
+
+# Use the (much faster) libyaml-based loader, when it is available.
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# The minimum size of the per-connection prepared statement cache.
+MIN_CACHED_STATEMENTS = 128
+
+# Number of read-only connections pooled for each database file.
+DEFAULT_READERS = 4
+
+# Pools (queue.Queue) of read-only connections, by database path, with
+# the (count, pragmas) they were opened with, and the number of DB
+# instances using them. A pool is shared by all DB instances for the same
+# database, and closed when the last of them is closed.
+_POOLS = { }
+_POOLS_LOCK = threading.Lock()
+
+
+class Row(dict):
+    "A dict of a row's columns, which may also be accessed as attributes."
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    __setattr__ = dict.__setitem__
+    __delattr__ = dict.__delitem__
+
+
+class _ColumnsFirstRow(Row):
+    """A Row with a column named like a dict attribute, such as "items".
+
+    As with EasyDict, row.items is the column's value, rather than the
+    method. (Use dict.items(row), if needed.)
+    """
+
+    __slots__ = ()
+
+    def __getattribute__(self, name):
+        try:
+            return dict.__getitem__(self, name)
+        except KeyError:
+            return dict.__getattribute__(self, name)
+
+
+_ROW_ATTRS = frozenset(dir(Row))
+
+
+class RowFactory:
+    """A row factory, which constructs a Row of each row.
+
+    Each cursor (or connection) has its own, to remember the column names
+    of its query. All rows of a query share the same description object.
+    """
+
+    __slots__ = ('_columns',)
+
+    def __init__(self):
+        # (cursor.description, column names, Row class)
+        self._columns = (None, None, None)
+
+    def __call__(self, cursor, row):
+        description, names, row_class = self._columns
+        if cursor.description is not description:
+            description = cursor.description
+            names = [column[0] for column in description]
+            if _ROW_ATTRS.isdisjoint(names):
+                row_class = Row
+            else:
+                row_class = _ColumnsFirstRow
+            self._columns = (description, names, row_class)
+        return row_class(zip(names, row))
+
+
+def _reader_pool(fname, count, pragmas):
+    "Return the (resolved) path of FNAME, and its pool of read-only connections."
+    path = pathlib.Path(fname).resolve()
+    with _POOLS_LOCK:
+        if path in _POOLS:
+            pool, settings, users = _POOLS[path]
+            if settings != (count, pragmas):
+                warnings.warn(f'{path} already has a pool of readers, with other'
+                              f' settings: {settings}. Using that pool.',
+                              RuntimeWarning, stacklevel=4)
+        else:
+            pool = queue.Queue()
+            settings = (count, dict(pragmas))
+            users = 0
+            for _ in range(count):
+                conn = sqlite3.connect(f'{path.as_uri()}?mode=ro', uri=True,
+                                       isolation_level=None,
+                                       check_same_thread=False)
+                conn.row_factory = RowFactory()
+                for name, value in pragmas.items():
+                    # The journal mode belongs to the database, and
+                    # cannot be changed through a read-only connection.
+                    if name != 'journal_mode':
+                        conn.execute(f'PRAGMA {name}={value}')
+                pool.put(conn)
+        _POOLS[path] = (pool, settings, users + 1)
+        return path, pool
+
+
+def _release_reader_pool(path):
+    "Release one use of the pool for PATH, closing it after the last."
+    with _POOLS_LOCK:
+        pool, settings, users = _POOLS[path]
+        if users > 1:
+            _POOLS[path] = (pool, settings, users - 1)
+            return
+        del _POOLS[path]
+    while True:
+        try:
+            pool.get_nowait().close()
+        except queue.Empty:
+            break
 
 
 class DB:
     """Wrapper/functional class for accessing Sqlite3 databases.
 
-    This class focuses on returning EasyDict instances for query results,
+    This class focuses on returning Row instances for query results,
     so that columns can be indexed by name instead of position.
 
     In addition, it makes it easy to create cursors for later usage. Naming
@@ -47,39 +183,115 @@ class DB:
     the statement or query. These cursors may be establishing through the
     use a .yaml file to clarify the SQL operations in a file for that
     purpose, instead of mixing them throughout a codebase.
-    """
 
-    def __init__(self, fname, yaml_fname=None, yaml_section='queries'):
+    Call .close() when done, to close the connections.
+    """
 
-        def row_factory(cursor, row):
-            "Return an EasyDict of the row, for attribute access."
-            return easydict.EasyDict(sqlite3.Row(cursor, row))
+    def __init__(self, fname, yaml_fname=None, yaml_section='queries',
+                 pragmas=None, readers=DEFAULT_READERS):
 
-        # Note: isolation_level=None means autocommit mode.
-        self.conn = sqlite3.connect(fname, isolation_level=None)
-        self.conn.row_factory = row_factory
+        if pragmas is None:
+            pragmas = DEFAULT_PRAGMAS.copy()
 
-        # If a YAML file containing SQL queries is presented, then create
-        # cursors for each statement, and storing those cursors as (named)
-        # attributes on SELF, for later use by the calling application.
+        # If a YAML file containing SQL queries is presented, then we
+        # will create cursors for each statement (see below).
+        queries = { }
         if yaml_fname:
             # Note: this could be a general configuration file for the
             # application. We'll look at just one section of it.
-            yml = yaml.safe_load(open(yaml_fname))
+            with open(yaml_fname, 'rb') as f:
+                yml = yaml.load(f, Loader=YAML_LOADER)
 
             # The YAML_SECTION (default "queries") should have names of
             # queries, to use as attributes, and the value should be the
             # SQL statement/query.
-            for name, sql in yml.get(yaml_section, { }).items():
-                if hasattr(self, name):
-                    ### fix this exception
-                    raise Exception(f'duplicate: {name}')
-                #print(f'{name}: {sql}')
-                setattr(self, name, self.cursor_for(sql))
+            queries = yml.get(yaml_section, { })
+
+        # Note: isolation_level=None means autocommit mode.
+        # Size the statement cache to hold all of the named queries, plus
+        # some room for ad-hoc statements.
+        self.conn = sqlite3.connect(
+            fname, isolation_level=None,
+            cached_statements=max(MIN_CACHED_STATEMENTS, 2 * len(queries)),
+            check_same_thread=False)
+        self.conn.row_factory = RowFactory()
+        for name, value in pragmas.items():
+            self.conn.execute(f'PRAGMA {name}={value}')
+
+        # Read-only connections for other threads to query with, opened
+        # upon the first borrow(). An in-memory database is visible to
+        # just one connection.
+        self.readers = None
+        self._readers_path = None
+        if fname in (':memory:', ''):
+            readers = 0
+        self._readers_args = (fname, readers, pragmas)
+
+        # Check the names of the statements, which will be used as
+        # attributes on SELF, to hold their cursors (see __getattr__).
+        for name in queries:
+            if hasattr(self, name):
+                ### fix this exception
+                raise Exception(f'duplicate: {name}')
+        self._queries = dict(queries)
+
+    def __getattr__(self, name):
+        "Create the cursor for a named statement, upon its first use."
+        # Note: __dict__ is used, to avoid recursion before _queries is set.
+        try:
+            sql = self.__dict__.get('_queries', { })[name]
+        except KeyError:
+            raise AttributeError(name) from None
+        #print(f'{name}: {sql}')
+        cursor = self.cursor_for(sql)
+
+        # Store the cursor as a (named) attribute on SELF, so later uses
+        # by the application will not come through here.
+        setattr(self, name, cursor)
+        return cursor
 
     def cursor_for(self, statement):
         "Return our custom cursor for the given statement."
-        return self.conn.cursor(_Cursor.factory_for(statement))
+        cursor = self.conn.cursor(_Cursor.factory_for(statement))
+        # Note: conn.cursor() gives the new cursor the connection's row
+        # factory. Each cursor needs its own, for its query's columns.
+        cursor.row_factory = RowFactory()
+        return cursor
+
+    @contextlib.contextmanager
+    def borrow(self):
+        """Borrow a read-only connection from the pool, for the duration
+        of the context. Threads can query concurrently, using these.
+
+        Falls back to the (one) read/write connection for databases which
+        have no pool of readers, such as in-memory databases.
+        """
+        if self.readers is None:
+            fname, readers, pragmas = self._readers_args
+            if not readers:
+                yield self.conn
+                return
+            self._readers_path, self.readers = _reader_pool(fname, readers, pragmas)
+        conn = self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put(conn)
+
+    def close(self):
+        """Close the read/write connection, and release the pool of readers.
+
+        The pool's connections are closed once no other DB uses the pool.
+        Borrowed connections must have been returned.
+        """
+        if self.readers is not None:
+            _release_reader_pool(self._readers_path)
+            self.readers = None
+        self.conn.close()
+
+
+# Executing this (cheap, empty) statement resets the cursor's prior one.
+_RESET_STATEMENT = 'SELECT 0 WHERE 0'
 
 
 class _Cursor(sqlite3.Cursor):
@@ -97,19 +309,26 @@ class _Cursor(sqlite3.Cursor):
     def perform(self, *params):
         "Perform the statement with PARAMs, or prepare the query."
 
-        # Use the exact same STATEMENT each time. Python's SQLite module
-        # caches the parsed statement, if the string is the same object.
+        # Use the same STATEMENT each time. Python's SQLite module caches
+        # the parsed statement, by its text (see cached_statements).
         self.execute(self.statement, params)
 
     def first_row(self, *params):
-        "Helper method to fetch the first row of a query."
+        """Helper method to fetch the first row of a query.
+
+        Note: if the query has further rows, the cursor is left with the
+        .description of an (empty) statement used to discard them.
+        """
         self.perform(*params)
         row = self.fetchone()
-        # We do not want to close the cursor. Thus, we must run the fetch
-        # to completion instead. For queries using .first_row() this should
-        # be no further rows.
-        _ = self.fetchall()
-        return row  # note the ROW_FACTORY implies this is an EasyDict
+        # We do not want to close the cursor, but we must finish with the
+        # statement (which otherwise holds a read lock). Queries used with
+        # .first_row() should have just the one row, which finishes it.
+        # Rather than fetch any others, run a trivial statement, which
+        # resets it.
+        if row is not None and self.fetchone() is not None:
+            self.execute(_RESET_STATEMENT)
+        return row  # note the ROW_FACTORY implies this is a Row
 
 
 if __name__ == '__main__':
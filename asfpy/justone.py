@@ -35,9 +35,17 @@
 # then the module tests if the FIFO is "stale" (based on time) and
 # removes it, or exits without running.
 #
+# ALTERNATIVE
+#
+# flock_run() instead takes an advisory lock on a regular file. The
+# kernel releases the lock when the process exits (even by crashing),
+# so there is no staleness to detect, and no races with removal. The
+# lock file is left in place.
+#
 
 
 import os
+import fcntl
 import errno
 import time
 import contextlib
@@ -48,25 +56,14 @@ DID_NOT_RUN = object()
 
 
 def maybe_run(fifo_fname, func, stale=STALE):
-    try:
-        info = os.stat(fifo_fname)
-    except OSError:
-        # Some error (assume it doesn't exist), so run the func
-        return _run_func(fifo_fname, func)
-
     # Opening a FIFO in non-blocking will throw ENXIO if no reader
     # is on the other end.
     try:
         fd = os.open(fifo_fname, os.O_WRONLY | os.O_NONBLOCK)
 
-        # Successful open means a reader exists. Thus, we're done.
-        os.close(fd)
-        return DID_NOT_RUN
-
     except OSError as e:
         if e.errno == errno.ENOENT:
-            # RACE: the FIFO just disappeared. Meaning another
-            # process *just* completed. Go ahead and run the func.
+            # No FIFO, so no other process is running. Run the func.
             return _run_func(fifo_fname, func)
 
         # Note: ENXIO means there is no reader on the other end.
@@ -79,6 +76,13 @@ def maybe_run(fifo_fname, func, stale=STALE):
         # There is no reader process, but the FIFO exists. Could be
         # a race condition (FIFO is opening/closing in the reader),
         # or maybe a stale FIFO.
+        try:
+            info = os.stat(fifo_fname)
+        except OSError:
+            # RACE: the FIFO just disappeared. Meaning another
+            # process *just* completed. Go ahead and run the func.
+            return _run_func(fifo_fname, func)
+
         if time.time() - info.st_mtime > stale:
             ### RACE: we might be removing another runner's FIFO
             os.unlink(fifo_fname)
@@ -87,6 +91,27 @@ def maybe_run(fifo_fname, func, stale=STALE):
         # Not stale (yet). Don't do anything for now.
         return DID_NOT_RUN
 
+    # Successful open means a reader exists. Thus, we're done.
+    os.close(fd)
+    return DID_NOT_RUN
+
+
+def flock_run(lock_fname, func):
+    fd = os.open(lock_fname, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another process holds the lock.
+            return DID_NOT_RUN
+
+        try:
+            return func()
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
 
 def _run_func(fifo_fname, func):
     with _temp_fifo(fifo_fname) as okay:
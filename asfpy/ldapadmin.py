@@ -25,8 +25,10 @@ assert sys.version_info >= (3, 2)
 
 import ldap
 import ldap.modlist
+import ldap.controls
+from passlib.hash import sha512_crypt
 import re
-import crypt
+import bisect
 import random
 import string
 
@@ -45,6 +47,18 @@ LDAP_CN = 'cn=%s,%s'
 # INFRA-21590 ApacheID cannot have dashes.
 LDAP_VALID_UID_RE = re.compile(r"^[a-z0-9][a-z0-9_]+$")
 LDAP_VALID_CN_RE = re.compile(r"^[-._a-z0-9]+$")  # Valid cn, not necessarily what we consider a valid UID
+LDAP_VALID_BIND_UID_RE = re.compile(r"^[-_a-z0-9]+$")  # Valid uid for the manager to bind with
+VALID_EMAIL_RE = re.compile(r"[^\s@]+@[^\s@]+\.[^\s@]+")  # Use with fullmatch
+MAX_EMAIL_LENGTH = 254  # RFC 5321 limit on the length of a forward-path
+
+# Characters, and the number of them, for generated passwords
+PASSWORD_ALPHABET = string.ascii_letters + string.digits
+PASSWORD_LENGTH = 16
+_SYSRANDOM = random.SystemRandom()  # The OS's secure source of randomness
+
+# Rounds of SHA-512 crypt for password hashes (LDAP checks them as {CRYPT})
+PASSWORD_CRYPT_ROUNDS = 656000
+
 # New user account UIDs will be larger than this value.
 # Conversely: service accounts will be less than this.
 # NOTE: this value was chosen to ensure enough lower-value
@@ -63,19 +77,27 @@ assert MINIMUM_USER_UID > MINIMUM_SVC_UID
 ASSERTION_FAILED = "Common backend assertions failed, LDAP corruption?"
 BACKEND_TIMEOUT = "The backend authentication server timed out, please retry later."
 
+# Kinds of group membership: the base of their groups, and the attribute holding the members
+MEMBERSHIPS = {
+    'project': (LDAP_PMCS_BASE, 'member'),  # committer
+    'pmc': (LDAP_PMCS_BASE, 'owner'),
+    'group': (LDAP_GROUPS_BASE, 'memberUid'),  # basic posixGroup
+    'role': (LDAP_ROLES_BASE, 'member'),
+}
+
+# Attributes to fetch when only testing whether an entry exists
+EXISTS_ATTRLIST = ['uid']
+
+# Number of entries per page, for searches that may return many entries
+SEARCH_PAGE_SIZE = 1000
+
 def bytify(ldiff):
     """ Convert all values in a dict to byte-string """
     for k, v in ldiff.items():
-        if type(v) is list:
-            n = 0
-            for xv in v:
-                if type(v[n]) is str:
-                    v[n] = xv.encode('utf-8')
-                n += 1
-        else:
-            if type(v) is str:
-                v = [v.encode('utf-8')]
-        ldiff[k] = v
+        if isinstance(v, list):
+            ldiff[k] = [xv.encode('utf-8') if isinstance(xv, str) else xv for xv in v]
+        elif isinstance(v, str):
+            ldiff[k] = [v.encode('utf-8')]
     return ldiff
 
 
@@ -83,18 +105,13 @@ def stringify(ldiff):
     """ Convert all values in a dict to string """
     for k, v in ldiff.items():
         # Convert single-list to string
-        if type(v) is list and len(v) == 1:
+        if isinstance(v, list) and len(v) == 1:
             v = v[0]
 
-        if type(v) is list:
-            n = 0
-            for xv in v:
-                if type(v[n]) is bytes:
-                    v[n] = xv.decode('utf-8')
-                n += 1
-        else:
-            if type(v) is bytes:
-                v = v.decode('utf-8')
+        if isinstance(v, list):
+            v = [xv.decode('utf-8') if isinstance(xv, bytes) else xv for xv in v]
+        elif isinstance(v, bytes):
+            v = v.decode('utf-8')
         ldiff[k] = v
     return ldiff
 
@@ -122,46 +139,51 @@ class committer:
         self.dn_enc = self.dn.encode('ascii')
         self.attributes = stringify(res[0][1])
         self.uid = self.attributes['uid']
+        self.uid_enc = self.uid.encode('ascii')
+
+    def apply_memberships(self, adds=(), removes=()):
+        """ Add/remove person to/from groups, given as (kind, name) pairs. See MEMBERSHIPS for the kinds. """
+        # Gather the changes for each group, to apply them in one round-trip per group
+        changes = {}
+        for op, memberships in ((ldap.MOD_ADD, adds), (ldap.MOD_DELETE, removes)):
+            for kind, name in memberships:
+                base, attr = MEMBERSHIPS[kind]
+                value = self.uid_enc if attr == 'memberUid' else self.dn_enc
+                changes.setdefault(LDAP_CN % (name, base), []).append((op, attr, value))
+        for dn, changeset in changes.items():
+            self.manager.lc.modify_s(dn, changeset)
 
     def add_project(self, project):
         """ Add person to project (as committer) """
-        dn = LDAP_CN % (project, LDAP_PMCS_BASE)
-        self.manager.lc.modify_s(dn, [(ldap.MOD_ADD, 'member', self.dn_enc)])
+        self.apply_memberships(adds=[('project', project)])
 
     def add_pmc(self, project):
         """ Add person to project (as PMC member) """
-        dn = LDAP_CN % (project, LDAP_PMCS_BASE)
-        self.manager.lc.modify_s(dn, [(ldap.MOD_ADD, 'owner', self.dn_enc)])
+        self.apply_memberships(adds=[('pmc', project)])
 
     def add_basic_group(self, group):
         """ Add person to basic posixGroup entry """
-        dn = LDAP_CN % (group, LDAP_GROUPS_BASE)
-        self.manager.lc.modify_s(dn, [(ldap.MOD_ADD, 'memberUid', self.uid.encode('ascii'))])
+        self.apply_memberships(adds=[('group', group)])
 
     def add_role(self, role):
         """ Add person to basic posixGroup entry """
-        dn = LDAP_CN % (role, LDAP_ROLES_BASE)
-        self.manager.lc.modify_s(dn, [(ldap.MOD_ADD, 'member', self.dn_enc)])
+        self.apply_memberships(adds=[('role', role)])
 
     def remove_project(self, project):
         """ Remove person from project (as committer) """
-        dn = LDAP_CN % (project, LDAP_PMCS_BASE)
-        self.manager.lc.modify_s(dn, [(ldap.MOD_DELETE, 'member', self.dn_enc)])
+        self.apply_memberships(removes=[('project', project)])
 
     def remove_pmc(self, project):
         """ Remove person from PMC """
-        dn = LDAP_CN % (project, LDAP_PMCS_BASE)
-        self.manager.lc.modify_s(dn, [(ldap.MOD_DELETE, 'owner', self.dn_enc)])
+        self.apply_memberships(removes=[('pmc', project)])
 
     def remove_basic_group(self, group):
         """ Remove person from basic posixGroup entry """
-        dn = LDAP_CN % (group, LDAP_GROUPS_BASE)
-        self.manager.lc.modify_s(dn, [(ldap.MOD_DELETE, 'memberUid', self.uid.encode('ascii'))])
+        self.apply_memberships(removes=[('group', group)])
 
     def remove_role(self, role):
         """ Add person to basic posixGroup entry """
-        dn = LDAP_CN % (role, LDAP_ROLES_BASE)
-        self.manager.lc.modify_s(dn, [(ldap.MOD_DELETE, 'member', self.dn_enc)])
+        self.apply_memberships(removes=[('role', role)])
 
     def rename(self, newuid):
         """ Rename an account, fixing in all projects """
@@ -175,11 +197,11 @@ class committer:
             raise ValidatorException("Invalid UID, must match ^[a-z0-9][a-z0-9_]+$")
 
         # Test if uid exists
-        if self.manager.load_account(xuid):
+        if self.manager.load_account(xuid, EXISTS_ATTRLIST):
             raise ConnectionException("An account with this uid already exists")
 
         # Test for clashing cn's
-        res = self.manager.lc.search_s(LDAP_SUFFIX, ldap.SCOPE_SUBTREE, 'cn=%s' % xuid)
+        res = self.manager.lc.search_s(LDAP_SUFFIX, ldap.SCOPE_SUBTREE, 'cn=%s' % xuid, EXISTS_ATTRLIST)
         if res:
             raise ValidatorException("availid clashes with project name %s!" % res[0][0], 'uid')
 
@@ -187,27 +209,25 @@ class committer:
         changeset = []
         o_email = self.attributes['asf-committer-email'].encode('ascii')
         n_email = b'%s@apache.org' % newuid
-        o_homedir = self.attributes['homeDirectory'].encode('ascii')
         n_homedir = b'/home/%s' % newuid
         changeset.append((ldap.MOD_DELETE, 'asf-committer-email', o_email))
         changeset.append((ldap.MOD_ADD, 'asf-committer-email', n_email))
-        changeset.append((ldap.MOD_DELETE, 'homeDirectory', o_homedir))
-        changeset.append((ldap.MOD_ADD, 'homeDirectory', n_homedir))
+        changeset.append((ldap.MOD_REPLACE, 'homeDirectory', n_homedir))  # single-valued
         self.manager.lc.modify_s(self.dn, changeset)
 
         # Change DN
-        odn = self.dn_enc.decode('ascii')
         newdn = LDAP_DN % xuid
-        newdn_enc = newdn.encode('ascii')
-        print("Changing %s to %s" % (odn, newdn))
-        self.manager.lc.modrdn_s(odn, 'uid=%s' % xuid)
+        print("Changing %s to %s" % (self.dn, newdn))
+        self.manager.lc.modrdn_s(self.dn, 'uid=%s' % xuid)
         
         # Search and rename in LDAP groups
         self.manager.redirect_uid(self.uid, newuid)
 
         # Change in-object
         self.uid = xuid
-        self.dn_enc = newdn_enc
+        self.uid_enc = newuid
+        self.dn = newdn
+        self.dn_enc = newdn.encode('ascii')
 
 
 class manager:
@@ -215,7 +235,7 @@ class manager:
     """ Top LDAP Manager class for whomever is using the script """
     def __init__(self, user, password, host=LDAP_SANDBOX):
         # Verify correct user ID syntax, construct DN
-        if not re.match(r"^[-_a-z0-9]+$", user):
+        if not LDAP_VALID_BIND_UID_RE.match(user):
             raise ConnectionException("Invalid characters in User ID. Must be alphanumerical or dashes only.")
 
         # Init LDAP connection
@@ -237,9 +257,13 @@ class manager:
         self.dn = LDAP_DN % user
         self.lc = lc
 
+        # Sorted lists of the (uidNumbers, gidNumbers) in use. Loaded on
+        # demand, and updated as accounts are created.
+        self._uid_cache = None
+
         # Get full name etc
         try:
-            res = lc.search_s(LDAP_DN % user, ldap.SCOPE_BASE)
+            res = lc.search_s(LDAP_DN % user, ldap.SCOPE_BASE, attrlist=['cn'])
             assert(len(res) == 1)
             assert(len(res[0]) == 2)
             fn = res[0][1].get('cn')
@@ -253,7 +277,7 @@ class manager:
 
         # Get apldap status
         try:
-            res = lc.search_s(LDAP_APLDAP_BASE, ldap.SCOPE_BASE)
+            res = lc.search_s(LDAP_APLDAP_BASE, ldap.SCOPE_BASE, attrlist=['member'])
             assert(len(res) == 1)
             assert(len(res[0]) == 2)
             members = res[0][1].get('member')
@@ -264,52 +288,92 @@ class manager:
         except AssertionError:
             raise ConnectionException(ASSERTION_FAILED)
 
-    def load_account(self, uid):
+    def load_account(self, uid, attrlist=None):
+        """ Load the account for UID, with only ATTRLIST attributes (default: all) """
         if type(uid) is bytes:
             uid = uid.decode('ascii')
         # Check if account exists!
-        res = self.lc.search_s(LDAP_PEOPLE_BASE, ldap.SCOPE_SUBTREE, 'uid=%s' % uid)
+        res = self.lc.search_s(LDAP_PEOPLE_BASE, ldap.SCOPE_SUBTREE, 'uid=%s' % uid, attrlist)
         if res:
             return committer(self, res)
         return None
 
     def _find_gaps(self, l):
-        return [item for item in range(l[0], l[-1]+1) if item not in l]
+        """ Return the missing values within the sorted list L """
+        taken = set(l)
+        return [item for item in range(l[0], l[-1]+1) if item not in taken]
+
+    def _search_paged(self, base, scope, filterstr, attrlist):
+        """ Search using server-side paging, and return all the results """
+        control = ldap.controls.SimplePagedResultsControl(True, size=SEARCH_PAGE_SIZE, cookie='')
+        results = []
+        while True:
+            msgid = self.lc.search_ext(base, scope, filterstr, attrlist, serverctrls=[control])
+            _rtype, rdata, _rmsgid, rctrls = self.lc.result3(msgid)
+            results.extend(rdata)
+            cookie = next((c.cookie for c in rctrls if c.controlType == control.controlType), None)
+            if not cookie:
+                return results
+            control.cookie = cookie
+
+    def _taken_uids(self, refresh=False):
+        """ Return sorted lists of the uidNumbers and gidNumbers in use """
+        if self._uid_cache is None or refresh:
+            r = self._search_paged(LDAP_PEOPLE_BASE, ldap.SCOPE_SUBTREE, 'uid=*', ['uidNumber', 'gidNumber'])
+            # Note: int() accepts the (ASCII digit) bytes values directly
+            un_avail_uids = []
+            un_avail_gids = []
+            for _dn, attrs in r:
+                un_avail_uids.append(int(attrs["uidNumber"][0]))
+                un_avail_gids.append(int(attrs["gidNumber"][0]))
+            un_avail_uids.sort()
+            un_avail_gids.sort()
+            self._uid_cache = (un_avail_uids, un_avail_gids)
+        return self._uid_cache
 
     def next_user_uid(self):
         """ Find lowest available user account uid with a matching available gid """
 
         try:
-            r = self.lc.search_s(LDAP_PEOPLE_BASE, ldap.SCOPE_SUBTREE, 'uid=*', ['uidNumber', 'gidNumber'])
-            un_avail_uids = sorted([int(item[1]["uidNumber"][0].decode('utf8')) for item in r])
-            un_avail_gids = sorted([int(item[1]["gidNumber"][0].decode('utf8')) for item in r])
-            avail_uids = self._find_gaps(un_avail_uids)
-            avail_gids = self._find_gaps(un_avail_gids)
-
-            # In case there are no gaps, increment the last returned UID
-            # If the new UID is not unavailable append it to the list of
-            # available_uids.
-            n_uid = int(un_avail_uids[-1]+1)
-            while n_uid in un_avail_gids:
-                n_uid+=1
-
-            avail_uids.append(n_uid)
+            cached = self._uid_cache is not None
+            uid = self._pick_user_uid(*self._taken_uids())
 
-            # Ensure you got something
-            assert(type(avail_uids) is list and len(avail_uids) > 0 and type(avail_gids) is list and len(avail_gids) > 0)
-
-            for uid in avail_uids:
-                if uid >= MINIMUM_USER_UID and uid in avail_gids:
-                    return(uid)
-                continue
-
-            raise ConnectionException('Unable to find a UID') # Should not happen, but ...
+            # Another process may have used this number since it was cached
+            if cached and self.lc.search_s(LDAP_PEOPLE_BASE, ldap.SCOPE_SUBTREE,
+                                           '(|(uidNumber=%d)(gidNumber=%d))' % (uid, uid), EXISTS_ATTRLIST):
+                uid = self._pick_user_uid(*self._taken_uids(refresh=True))
+            return uid
 
         except ldap.TIMEOUT:
             raise ConnectionException(BACKEND_TIMEOUT)
         except AssertionError:
             raise ConnectionException(ASSERTION_FAILED)
 
+    def _pick_user_uid(self, un_avail_uids, un_avail_gids):
+        """ Return the lowest user uid, given the (sorted) numbers in use """
+        avail_uids = self._find_gaps(un_avail_uids)
+        avail_gids = set(self._find_gaps(un_avail_gids))
+
+        # In case there are no gaps, increment the last returned UID
+        # If the new UID is not unavailable append it to the list of
+        # available_uids.
+        taken_gids = set(un_avail_gids)
+        n_uid = int(un_avail_uids[-1]+1)
+        while n_uid in taken_gids:
+            n_uid+=1
+
+        avail_uids.append(n_uid)
+
+        # Ensure you got something
+        assert(type(avail_uids) is list and len(avail_uids) > 0 and len(avail_gids) > 0)
+
+        for uid in avail_uids:
+            if uid >= MINIMUM_USER_UID and uid in avail_gids:
+                return(uid)
+            continue
+
+        raise ConnectionException('Unable to find a UID') # Should not happen, but ...
+
     def create_account(
         self,
         uid,
@@ -327,11 +391,11 @@ class manager:
             raise ValidatorException("Invalid UID, must match ^[a-z0-9][a-z0-9_]+$")
 
         # Test if uid exists
-        if self.load_account(uid):
+        if self.load_account(uid, EXISTS_ATTRLIST):
             raise ConnectionException("An account with this uid already exists")
 
         # Test for clashing cn's
-        res = self.lc.search_s(LDAP_SUFFIX, ldap.SCOPE_SUBTREE, 'cn=%s' % uid)
+        res = self.lc.search_s(LDAP_SUFFIX, ldap.SCOPE_SUBTREE, 'cn=%s' % uid, EXISTS_ATTRLIST)
         if res:
             raise ValidatorException("availid clashes with project name %s!" % res[0][0], 'uid')
 
@@ -356,14 +420,14 @@ class manager:
                 raise ValidatorException("Found part of name with too much spacing!", 'fullname')
 
         # Validate email
-        if not re.match(r"^\S+@\S+?\.\S+$", email):
+        if len(email) > MAX_EMAIL_LENGTH or not VALID_EMAIL_RE.fullmatch(email):
             raise ValidatorException("Invalid email address supplied!", 'email')
 
         # Set password, b64-encoded crypt of random string
-        password = ''.join(random.choice(string.ascii_letters + string.digits) for i in range(16))
+        password = ''.join(_SYSRANDOM.choices(PASSWORD_ALPHABET, k=PASSWORD_LENGTH))
         if forcePass:
             password = forcePass
-        password_crypted = crypt.crypt(password, crypt.mksalt(method=crypt.METHOD_MD5))
+        password_crypted = sha512_crypt.using(rounds=PASSWORD_CRYPT_ROUNDS).hash(password)
 
         ldiff = {
             'objectClass': ['person', 'top', 'posixAccount', 'organizationalPerson', 'inetOrgPerson', 'asf-committer', 'hostObject', 'ldapPublicKey'],
@@ -393,6 +457,11 @@ class manager:
         am = ldap.modlist.addModlist(ldiff)
         self.lc.add_s(dn, am)
 
+        # Keep the cached numbers current, for the next account
+        if self._uid_cache:
+            bisect.insort(self._uid_cache[0], uidnumber)
+            bisect.insort(self._uid_cache[1], int(ldiff['gidNumber'][0]))
+
         return self.load_account(uid)
 
     def redirect_uid(self, from_uid: str, to_uid: str):
@@ -417,25 +486,33 @@ class manager:
         from_uid_enc = from_uid.encode('ascii')
         to_uid_enc = to_uid.encode('ascii')
         
+        # Issue both searches at once, so they overlap on the server,
+        # and then collect the results.
+        long_roles = ['member', 'owner']
+        long_msgid = self.lc.search_ext(LDAP_SUFFIX, ldap.SCOPE_SUBTREE, '(|(member=%s)(owner=%s))' % (from_dn, from_dn), long_roles)
+        short_msgid = self.lc.search_ext(LDAP_SUFFIX, ldap.SCOPE_SUBTREE, '(&(objectClass=posixGroup)(memberUid=%s))' % from_uid, ['memberUid'])
+        _rtype, long_res = self.lc.result(long_msgid)
+        _rtype, short_res = self.lc.result(short_msgid)
+
         # Replace long refs: member + owner
-        for role in ['member', 'owner']:
-            res = self.lc.search_s(LDAP_SUFFIX, ldap.SCOPE_SUBTREE, '%s=%s' % (role, from_dn))
-            for entry in res:
-                cn = entry[0]
-                myhash = entry[1]
-                if from_dn_enc in myhash[role]:
+        for entry in long_res:
+            cn = entry[0]
+            myhash = entry[1]
+            changeset = []
+            for role in long_roles:
+                if from_dn_enc in myhash.get(role, []):
                     print("Modifying (long) %s attribute in %s ..." % (role, cn))
-                    self.lc.modify_s(cn, [(ldap.MOD_DELETE, role, from_dn_enc)])
-                    self.lc.modify_s(cn, [(ldap.MOD_ADD, role, to_dn_enc)])
+                    changeset.append((ldap.MOD_DELETE, role, from_dn_enc))
+                    changeset.append((ldap.MOD_ADD, role, to_dn_enc))
+            if changeset:
+                # Swap the values with one (atomic) round-trip
+                self.lc.modify_s(cn, changeset)
 
         # Replace short refs: memberUid
-        for role in ['memberUid']:
-            res = self.lc.search_s(LDAP_SUFFIX, ldap.SCOPE_SUBTREE, '(&(objectClass=posixGroup)(%s=%s))' % (role, from_uid))
-            for entry in res:
-                cn = entry[0]
-                myhash = entry[1]
-                if from_uid_enc in myhash[role]:
-                    print("Modifying (short) %s attribute in %s ..." % (role, cn))
-                    self.lc.modify_s(cn, [(ldap.MOD_DELETE, role, from_uid_enc)])
-                    self.lc.modify_s(cn, [(ldap.MOD_ADD, role, to_uid_enc)])
-
+        role = 'memberUid'
+        for entry in short_res:
+            cn = entry[0]
+            myhash = entry[1]
+            if from_uid_enc in myhash[role]:
+                print("Modifying (short) %s attribute in %s ..." % (role, cn))
+                self.lc.modify_s(cn, [(ldap.MOD_DELETE, role, from_uid_enc), (ldap.MOD_ADD, role, to_uid_enc)])
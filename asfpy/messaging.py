@@ -35,8 +35,20 @@ if not __debug__:
 
 import email.utils
 import email.header
+import email.message
+import email.policy
 import smtplib
+import socket
+import ssl
+import re
+import time
+import queue
+import threading
+import contextlib
 import warnings
+import weakref
+
+import asfpy.whoami
 
 # Message submission uses port 587.
 #   https://www.rfc-editor.org/rfc/rfc6409
@@ -45,6 +57,34 @@ SMTP_PORT = 587
 # Apache/Infra code defaults to this MSA for sending email.
 DEFAULT_MSA = 'mail-relay.apache.org'
 
+# TLS settings for STARTTLS, created once rather than for each connection.
+# Like smtplib's default, this does not verify the MSA's certificate, as
+# relays (such as on localhost) often use self-signed certificates.
+TLS_CONTEXT = ssl.create_default_context()
+TLS_CONTEXT.check_hostname = False
+TLS_CONTEXT.verify_mode = ssl.CERT_NONE
+TLS_CONTEXT.minimum_version = ssl.TLSVersion.TLSv1_2
+
+# For verify_tls=True: check the MSA's certificate, and its hostname.
+VERIFIED_TLS_CONTEXT = ssl.create_default_context()
+VERIFIED_TLS_CONTEXT.minimum_version = ssl.TLSVersion.TLSv1_2
+
+# An SMTPSession which has been idle for this many seconds will check
+# that its connection is still alive (NOOP), before sending with it.
+NOOP_INTERVAL = 30
+
+# Relays may limit the number of messages sent over one connection. An
+# SMTPPool will reconnect each session, after sending this many.
+DEFAULT_MAX_MSGS_PER_CONN = 5000
+
+# Line endings of any style, in a message body. SMTP requires CRLF.
+LINE_END_RE = re.compile(r'\r\n|\r|\n')
+LINE_END_BYTES_RE = re.compile(br'\r\n|\r|\n')
+
+# Lines of a message which start with a period, which must be doubled
+# when sent with DATA (RFC 5321, section 4.5.2).
+LEADING_PERIOD_RE = re.compile(br'^\.', re.MULTILINE)
+
 
 def uniaddr(addr):
     """ Unicode-format an email address """
@@ -52,11 +92,302 @@ def uniaddr(addr):
     return email.utils.formataddr((email.header.Header(bits[0], 'utf-8').encode(), bits[1]))
 
 
+class PipelinedSMTP(smtplib.SMTP):
+    """ An SMTP client which pipelines its commands (RFC 2920).
+
+    When the server supports PIPELINING, sendmail() writes MAIL, each
+    RCPT, and DATA together, then reads their replies: one round-trip,
+    rather than one for each command.
+    """
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn('pipelining') \
+           or any(x.lower() == 'smtputf8' for x in mail_options):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+
+        if isinstance(msg, str):
+            msg = LINE_END_RE.sub('\r\n', msg).encode('ascii')
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        mail_options = list(mail_options)
+        if self.has_extn('size'):
+            mail_options.insert(0, 'size=%d' % len(msg))
+
+        commands = ['mail FROM:%s%s' % (smtplib.quoteaddr(from_addr),
+                                        ''.join(' ' + x for x in mail_options))]
+        rcpt_optionlist = ''.join(' ' + x for x in rcpt_options)
+        for addr in to_addrs:
+            commands.append('rcpt TO:%s%s' % (smtplib.quoteaddr(addr), rcpt_optionlist))
+        commands.append('data')
+        self.send(''.join(cmd + smtplib.CRLF for cmd in commands))
+
+        # Read a reply for each command, to stay in step with the server,
+        # unless the server is closing the connection.
+        replies = [ ]
+        for _ in commands:
+            replies.append(self.getreply())
+            if replies[-1][0] == 421:
+                self.close()
+                break
+        mail_reply = replies[0]
+        rcpt_replies = replies[1:len(to_addrs)+1]
+        data_reply = replies[len(to_addrs)+1:]
+
+        senderrs = { }
+        for addr, (code, resp) in zip(to_addrs, rcpt_replies):
+            if code != 250 and code != 251:
+                senderrs[addr] = (code, resp)
+
+        if mail_reply[0] != 250 or not data_reply or data_reply[0][0] != 354 \
+           or len(senderrs) == len(to_addrs):
+            if data_reply and data_reply[0][0] == 354:
+                # There is nothing to deliver, but the server is waiting
+                # for the message. End it, empty.
+                self.send(b'.' + smtplib.bCRLF)
+                self.getreply()
+            self._rset()
+            if mail_reply[0] != 250:
+                raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+            if not data_reply or len(senderrs) == len(to_addrs):
+                raise smtplib.SMTPRecipientsRefused(senderrs)
+            raise smtplib.SMTPDataError(*data_reply[0])
+
+        # Same as SMTP.data(), once the server has accepted DATA.
+        q = LEADING_PERIOD_RE.sub(b'..', msg)
+        if q[-2:] != smtplib.bCRLF:
+            q = q + smtplib.bCRLF
+        q = q + b'.' + smtplib.bCRLF
+        self.send(q)
+        (code, resp) = self.getreply()
+        if code != 250:
+            if code == 421:
+                self.close()
+            else:
+                self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return senderrs
+
+
+class SMTPSession:
+    """ A connection to an MSA, for sending any number of messages.
+
+    The connection is opened (STARTTLS, and AUTH) upon the first send,
+    and re-opened if the MSA has dropped it. Use as a context manager,
+    or call close() when done.
+    """
+
+    # Commands are small writes, sent back to back; do not delay them
+    # (Nagle). Keepalives detect an MSA which has silently gone away,
+    # while the session sits idle. These may be tuned on the class.
+    TCP_SOCKET_OPTIONS = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+    if hasattr(socket, 'TCP_KEEPIDLE'):  # Linux-specific
+        TCP_SOCKET_OPTIONS += [
+            (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60),
+        ]
+
+    def __init__(self, host=DEFAULT_MSA, auth=None, verify_tls=False):
+        self.host = host
+        self.auth = auth  # (user, pass)
+        self.verify_tls = verify_tls
+        self.smtp = None
+        self.last_success = 0.0
+        self.count = 0  # Messages sent over this connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self):
+        "Open a new connection to the MSA."
+        # Note: split off the port here, rather than passing "HOST:PORT" to
+        # smtplib, which would then check the certificate against that.
+        hostname, sep, port = self.host.rpartition(':')
+        if sep:  # Port specified in hostname
+            smtp = PipelinedSMTP(hostname, int(port))
+        else:  # Default port
+            smtp = PipelinedSMTP(self.host, SMTP_PORT)
+        try:
+            for level, option, value in self.TCP_SOCKET_OPTIONS:
+                smtp.sock.setsockopt(level, option, value)
+            smtp.starttls(context=VERIFIED_TLS_CONTEXT if self.verify_tls else TLS_CONTEXT)
+            if self.auth:
+                smtp.login(*self.auth)  # user, pwd
+        except BaseException:
+            smtp.close()
+            raise
+        self.smtp = smtp
+        self.count = 0
+
+    def alive(self):
+        "Return whether the connection is still usable, checking it if it has been idle."
+        if self.smtp is None:
+            return False
+        if self.smtp.sock is None:  # Closed, after the MSA said goodbye (421)
+            self.smtp = None
+            return False
+        if time.monotonic() - self.last_success < NOOP_INTERVAL:
+            return True
+        try:
+            alive = self.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            alive = False
+        if not alive:
+            self.smtp.close()
+            self.smtp = None
+        return alive
+
+    def send(self, sender, recipients, msg):
+        "Send the (encoded) MSG, reconnecting if needed."
+        if not self.alive():
+            self.connect()
+        self.smtp.sendmail(sender, recipients, msg)
+        self.last_success = time.monotonic()
+        self.count += 1
+
+    def close(self):
+        "Close the connection, if it is open."
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                # The connection went away, which is just fine.
+                self.smtp.close()
+            self.smtp = None
+
+
+class SMTPPool:
+    """ A pool of SMTPSession instances, for concurrent senders.
+
+    At most MAX_SIZE sessions are used at once. A session reconnects
+    after sending MAX_MSGS_PER_CONN messages. Idle sessions are checked
+    every CHECK_INTERVAL seconds by a background thread (None to skip).
+
+    Call close() when done with the pool. (A pool which is dropped
+    without it is closed when garbage-collected, which may be later.)
+    """
+
+    def __init__(self, host=DEFAULT_MSA, auth=None, max_size=5,
+                 max_msgs_per_conn=DEFAULT_MAX_MSGS_PER_CONN,
+                 check_interval=NOOP_INTERVAL, verify_tls=False):
+        self.host = host
+        self.auth = auth  # (user, pass)
+        self.verify_tls = verify_tls
+        self.max_size = max_size
+        self.max_msgs_per_conn = max_msgs_per_conn
+        self.idle = queue.LifoQueue()  # Most recently used first
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.closed = threading.Event()
+        # The checker thread holds the pool weakly, so a dropped pool is
+        # still collected. That closes its sessions, and ends the thread.
+        self._finalizer = weakref.finalize(self, _close_idle, self.idle, self.closed)
+        if check_interval:
+            threading.Thread(target=_check_idle, name='SMTPPool-check',
+                             args=(weakref.ref(self), self.closed, check_interval),
+                             daemon=True).start()
+
+    @contextlib.contextmanager
+    def acquire(self):
+        "Borrow an SMTPSession from the pool, for the duration of the context."
+        with self.slots:
+            try:
+                session = self.idle.get_nowait()
+            except queue.Empty:
+                session = SMTPSession(self.host, self.auth, self.verify_tls)
+            try:
+                yield session
+            except BaseException:
+                # Do not trust the state of the connection.
+                session.close()
+                raise
+            finally:
+                self.release(session)
+
+    def release(self, session):
+        "Return SESSION to the pool."
+        if session.count >= self.max_msgs_per_conn:
+            session.close()
+        if self.closed.is_set() or self.idle.qsize() >= self.max_size:
+            session.close()
+        else:
+            self.idle.put(session)
+
+    def close(self):
+        "Close the idle sessions, and those released later."
+        self._finalizer()
+
+    def check_idle(self):
+        "Check each idle session, dropping dead connections."
+        for _ in range(self.idle.qsize()):
+            try:
+                session = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            session.alive()  # Drops a dead connection
+            self.release(session)
+
+
+def _close_idle(idle, closed):
+    "Close the sessions in IDLE, and (by setting CLOSED) those released later."
+    closed.set()
+    while True:
+        try:
+            idle.get_nowait().close()
+        except queue.Empty:
+            break
+
+
+def _check_idle(pool_ref, closed, interval):
+    "Check the idle sessions of the pool, until it is closed or collected."
+    while not closed.wait(interval):
+        pool = pool_ref()
+        if pool is None:
+            return
+        pool.check_idle()
+        del pool  # Do not keep the pool alive while waiting
+
+
 def thread_msgid(key):
     "Return a reproducible Message-ID value."
     return'<asfpy-%s@apache.org>' % (key,)
 
 
+def _build_message(sender, recipients, subject, message,
+                   messageid, date, in_reply_to, headers):
+    "Return the encoded email (bytes), from mail()'s checked arguments."
+    # Construct the headers of the email. The SMTP policy takes care of
+    # encoding any non-ASCII headers (such as the Subject, or names in
+    # addresses), and uses CRLF line endings.
+    msg = email.message.EmailMessage(policy=email.policy.SMTP)
+    msg['From'] = sender
+    msg['To'] = ", ".join(recipients)
+    msg['Subject'] = subject
+    msg['Message-ID'] = messageid
+    msg['Date'] = date
+    for key, val in headers.items():
+        msg[key] = str(val)
+    if in_reply_to:
+        msg['In-Reply-To'] = in_reply_to
+    msg['Content-Type'] = 'text/plain; charset=utf-8'
+    msg['Content-Transfer-Encoding'] = '8bit'
+    msg['MIME-Version'] = '1.0'
+
+    # The body is encoded on its own, and joined to the headers (and the
+    # blank line which ends them), rather than copied through the
+    # generator, line by line.
+    # Note: a bytes body is sent as-is (and should be UTF-8).
+    if isinstance(message, bytes):
+        body = LINE_END_BYTES_RE.sub(b'\r\n', message)
+    else:
+        body = LINE_END_RE.sub('\r\n', message).encode('utf-8')
+    return b''.join((msg.as_bytes(), body))
+
+
 def mail(
         ### need py2 compat. FUTURE:
         # *,  # Parameters must be passed as arg=value, not positionally
@@ -78,6 +409,12 @@ def mail(
         # Deprecated:  (use thread_*)
         messageid=None,
         headers=None,
+
+        session=None,  # SMTPSession; reuse its connection to send
+        pool=None,  # SMTPPool; send with a session from the pool
+
+        # Check the MSA's certificate (and hostname). Not done by default.
+        verify_tls=False,
 ):
     if headers is None:
         headers = { }
@@ -100,6 +437,7 @@ def mail(
         'All required arguments must be provided.'
 
     # Handle threading of email messages.
+    in_reply_to = None
     if thread_start:
         # Original post. Construct a very specific Message-ID which can
         # be referenced in follow-up emails.
@@ -107,13 +445,13 @@ def mail(
     elif thread_key:
         # This message is a response to the original post, identified by
         # a specific Message-ID that we constructed.
-        # Note: avoid modifying the passed HEADERS.
-        headers = headers.copy()
-        headers['In-Reply-To'] = thread_msgid(thread_key)
+        in_reply_to = thread_msgid(thread_key)
 
     # Optional metadata first
     if not messageid:
-        messageid = email.utils.make_msgid("asfpy")
+        # Note: make_msgid() would look up the FQDN for every call, which
+        # can be slow on hosts with poorly configured DNS. whoami() caches it.
+        messageid = email.utils.make_msgid("asfpy", domain=asfpy.whoami.whoami())
     date = email.utils.formatdate()
 
     # Now the required bits
@@ -131,47 +469,53 @@ def mail(
     # py 2 vs 3 conversion
     if isinstance(sender, bytes):
         sender = sender.decode('utf-8', errors='replace')
-    if isinstance(message, bytes):
-        message = message.decode('utf-8', errors='replace')
     for i, rec in enumerate(recipients):
         if isinstance(rec, bytes):
             rec = rec.decode('utf-8', errors='replace')
             recipients[i] = rec
 
-    # Recipient, Subject and Sender might be unicode.
-    subject_encoded = email.header.Header(subject, 'utf-8').encode()
-    sender_encoded = uniaddr(sender)
-    recipient_encoded = ", ".join([uniaddr(x) for x in recipients])
+    msg = _build_message(sender, recipients, subject, message,
+                         messageid, date, in_reply_to, headers)
 
-    extra = u""
-    if headers:
-        for key, val in headers.items():
-            try:
-                str(val).encode("us-ascii")
-            except UnicodeEncodeError:  # String has non-ascii elements, convert
-                val = email.header.Header(val, 'utf-8').encode()
-            extra += u"%s: %s\n" % (key, val)
-    extra += u"\n"
-
-    # Construct the email
-    msg = u"""From: %s
-To: %s	
-Subject: %s
-Message-ID: %s
-Date: %s
-Content-Type: text/plain; charset=utf-8
-Content-Transfer-Encoding: 8bit
-%s
-%s
-""" % (sender_encoded, recipient_encoded, subject_encoded, messageid, date, extra, message)
-    msg = msg.encode('utf-8', errors='replace')
     # Try to dispatch message, do a raw fail if stuff happens.
-    if ":" in host:  # Port specified in hostname
-        smtp_object = smtplib.SMTP(host)
-    else:  # Default port
-        smtp_object = smtplib.SMTP(host, SMTP_PORT)
-    smtp_object.starttls()
-    if auth:
-        smtp_object.login(*auth)  # user, pwd
     # Note that we're using the raw sender here...
-    smtp_object.sendmail(sender, recipients, msg)
+    if session is not None:
+        session.send(sender, recipients, msg)
+    elif pool is not None:
+        with pool.acquire() as session:
+            session.send(sender, recipients, msg)
+    else:
+        with SMTPSession(host, auth, verify_tls) as session:
+            session.send(sender, recipients, msg)
+
+
+def mail_many(msgs, host=DEFAULT_MSA, auth=None,
+              max_msgs_per_conn=DEFAULT_MAX_MSGS_PER_CONN, verify_tls=False):
+    """Send each of MSGS, which are dicts of arguments for mail().
+
+    All messages are sent over one connection (reconnecting after every
+    MAX_MSGS_PER_CONN messages). A message which fails does not stop the
+    others. Returns a dict of the failed messages' indexes in MSGS, and
+    their exceptions.
+    """
+    failures = { }
+    with SMTPSession(host, auth, verify_tls) as session:
+        for i, kwargs in enumerate(msgs):
+            try:
+                mail(session=session, **kwargs)
+            except (AssertionError, ValueError, TypeError) as e:
+                # Bad arguments. Nothing was sent.
+                failures[i] = e
+            except (smtplib.SMTPSenderRefused,
+                    smtplib.SMTPRecipientsRefused,
+                    smtplib.SMTPDataError) as e:
+                # The MSA refused this message, and the transaction was
+                # reset (RSET). The connection can be used for the next.
+                failures[i] = e
+            except (smtplib.SMTPException, OSError) as e:
+                # The state of the connection is unknown. Start over.
+                session.close()
+                failures[i] = e
+            if session.count >= max_msgs_per_conn:
+                session.close()
+    return failures
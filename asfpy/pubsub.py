@@ -23,6 +23,9 @@
 #
 # This will produce a series of payloads, forever.
 #
+# Synchronous code can use listen_sync(FUNC, PUBSUB_URL), to call
+# FUNC for each payload, forever.
+#
 # NOTE: this listener is intended for pypubsub, which terminates
 #   payloads with a newline. The old svnpubsub used NUL characters,
 #   so this client will not work with that server.
@@ -30,7 +33,6 @@
 
 import requests
 import requests.exceptions
-import json
 import time
 import sys
 import asyncio
@@ -39,6 +41,13 @@ import warnings
 
 import aiohttp
 
+# Use orjson for parsing payloads, when it is installed (it is much faster).
+# Either accepts the raw bytes of a payload.
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
 
 LOGGER = logging.getLogger(__name__)
 
@@ -125,7 +134,27 @@ async def _process_connection(session, pubsub_url):
                 # We just hit EOF.
                 yield None
 
-            yield json.loads(raw)
+            yield _json.loads(raw)
+
+
+async def _call_for_each(func, pubsub_url, auth=None, raw=False):
+    "Call FUNC for each payload from listen(), like listen_forever() does."
+    username, password = auth or (None, None)
+    async for payload in listen(pubsub_url, username, password):
+        if not raw and isinstance(payload, dict):
+            payload = payload.get('payload')
+        if payload:
+            func(payload)
+
+
+def listen_sync(func, pubsub_url, auth=None, raw=False):
+    """Listen on PUBSUB_URL forever, calling FUNC for each payload.
+
+    This runs listen() in a new event loop. AUTH is (username, password).
+    Unless RAW is true, FUNC is called with just the "payload" member of
+    each payload (and not for keepalives).
+    """
+    asyncio.run(_call_for_each(func, pubsub_url, auth, raw))
 
 
 def test_listening():
@@ -180,13 +209,27 @@ class Listener:
         auth = kwargs.get('auth', None)
         listen_forever(func, self.url, auth, raw, since, debug)
 
+    def attach_async(self, func, **kwargs):
+        """Listen in the running event loop, calling FUNC for each payload.
+
+        Returns the asyncio.Task doing the listening; cancel it to stop.
+        """
+        raw = kwargs.get('raw', False)
+        auth = kwargs.get('auth', None)
+        return asyncio.get_running_loop().create_task(
+            _call_for_each(func, self.url, auth, raw))
+
 
 def listen_forever(func, url, auth=None, raw=False, since=-1, debug=False):
     """Listen on URL forever, calling FUNC for each payload.
 
     ### more docco about FUNC calling, AUTH, RAW, SINCE, DEBUG
+
+    Deprecated: this blocks a thread for each URL. Use listen() within
+    an event loop, or listen_sync().
     """
-    warnings.warn('use listen() instead', DeprecationWarning)
+    warnings.warn('listen_forever() is deprecated; use listen() or listen_sync() instead',
+                  DeprecationWarning, stacklevel=2)
 
     while True:
         if debug:
@@ -211,13 +254,27 @@ def listen_forever(func, url, auth=None, raw=False, since=-1, debug=False):
                     message("[WARNING] %s did not respond with a streamable connection,"
                             " reconnecting in 10 seconds\n", url, sleep=10)
         try:
-            body = ""
+            buf = bytearray()
+            scanned = 0  # No terminator within BUF before this index
+            # Note: the server uses chunked encoding, and CHUNK_SIZE=None yields
+            # each HTTP chunk (typically, a whole payload) as soon as it arrives.
+            # With a fixed size, reads of unchunked streams would wait for that
+            # many bytes, delaying payloads. iter_lines() would add another
+            # (Python) layer of splitting, and does not know svnpubsub's \0.
             for chunk in connection.iter_content(chunk_size=None):
-                body += chunk.decode('utf-8', errors='ignore')
-                # pypubsub/gitpubsub payloads end in \n, svnpubsub payloads end in \0:
-                if body[-1] in ["\n", "\x00"]:
+                buf += chunk
+                # pypubsub/gitpubsub payloads end in \n, svnpubsub payloads end in \0.
+                # A chunk may hold the end of any number of payloads.
+                while True:
+                    end = _find_end(buf, scanned)
+                    if end == -1:
+                        scanned = len(buf)
+                        break
+                    body = buf[:end]
+                    del buf[:end+1]
+                    scanned = 0
                     try:
-                        payload = json.loads(body.rstrip("\r\n\x00"))
+                        payload = _json.loads(body)
                     except ValueError as detail:
                         if debug:
                             message("[WARNING] Bad JSON or something: %s\n", detail)
@@ -231,7 +288,6 @@ def listen_forever(func, url, auth=None, raw=False, since=-1, debug=False):
                         # header on the next retry in case this connection fails at some point.
                         since = -1
                         func(payload)
-                    body = ""
         except requests.exceptions.RequestException:
             if debug:
                 message("[WARNING] Disconnected from %s, reconnecting\n", url, sleep=2)
@@ -240,6 +296,14 @@ def listen_forever(func, url, auth=None, raw=False, since=-1, debug=False):
             message("Connection to %s was closed, reconnecting in 10 seconds\n", url, sleep=10)
 
 
+def _find_end(buf, start=0):
+    "Return the index of the first payload terminator in BUF after START, or -1."
+    newline = buf.find(b'\n', start)
+    # Only look for a NUL before the newline (if any).
+    nul = buf.find(b'\x00', start, len(buf) if newline == -1 else newline)
+    return newline if nul == -1 else nul
+
+
 def message(fmt, *args, sleep=None, fp=sys.stderr):
     fp.write(fmt % args)
     fp.flush()
@@ -22,29 +22,121 @@ if not __debug__:
 
 import sqlite3
 import typing
+import functools
+import time
 
 DEFAULT_ISOLATION_LEVEL = None  # When None, enables auto-commit mode in sqlite
 # https://docs.python.org/3/library/sqlite3.html#sqlite3.Connection.isolation_level
 
+# Size of the connection's cache of prepared statements. The document helpers make a
+# statement for each combination of table and columns, which can exceed the sqlite3
+# default of 128. Each cached statement costs a few KB; users with few tables and
+# queries can pass the default instead.
+DEFAULT_CACHED_STATEMENTS = 512
+
+# Maximum number of rows fetch() will read from sqlite at a time (see DB.fetch_arraysize)
+MAX_FETCH_ARRAYSIZE = 512
+
+# Maximum number of rows held by the fetchone() cache (see DB.enable_cache)
+MAX_CACHED_ROWS = 4096
+
+# PRAGMAs for file-backed databases, unless DB() is passed others. WAL journaling with
+# NORMAL synchronization avoids an fsync for each (auto-)commit, and remains safe against
+# corruption. Note the WAL journal mode persists in the database file. Pass pragmas={}
+# to DB() to keep the defaults of SQLite itself.
+FILE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+}
+
 class AsfpyDBError(Exception):
     pass
 
 
+@functools.lru_cache(maxsize=256)
+def _build_stmt(op: str, table: str, cols: tuple, target: typing.Optional[str] = None) -> str:
+    """
+    Builds the SQL statement for a document operation. Statements are cached, as the same
+    operations tend to be repeated on the same tables and columns.
+    @param op: The operation: delete, update, insert, upsert, select or select_limit
+    @param table: The table to operate on
+    @param cols: The document (or search) columns, in the order their values will be bound
+    @param target: The column locating the row to update/upsert
+    @return: The statement. Values are bound in the order of cols, then the target value, if any.
+             An upsert binds the column values twice, and select_limit binds the limit last.
+    """
+    if op == 'delete':
+        search = " AND ".join("`%s` = ?" % col for col in cols)
+        return f'DELETE FROM {table} WHERE {search}'
+    if op == 'update':
+        columns = ", ".join("%s = ?" % col for col in cols)
+        return f'UPDATE {table} SET {columns} WHERE {target} = ?;'
+    if op == 'insert':
+        columns = ", ".join("`%s`" % col for col in cols)
+        questionmarks = ", ".join(['?'] * len(cols))
+        return f'INSERT INTO {table} ({columns}) VALUES ({questionmarks});'
+    if op == 'upsert':
+        variables = ", ".join("`%s`" % col for col in cols)
+        questionmarks = ", ".join(['?'] * len(cols))
+        upserts = ", ".join("`%s` = ?" % col for col in cols)
+        return f'INSERT INTO {table} ({variables}) VALUES ({questionmarks}) ON CONFLICT({target}) DO UPDATE SET {upserts} WHERE {target} = ?;'
+    if op in ('select', 'select_limit'):
+        search = " AND ".join("`%s` = ?" % col for col in cols) or "1"
+        statement = f'SELECT * FROM {table} WHERE {search}'
+        if op == 'select_limit':
+            statement += ' LIMIT ?'
+        return statement
+    raise AsfpyDBError(f"Unknown operation: {op}")
+
+
 class DB:
-    def __init__(self, fp: str, isolation_level: typing.Optional[str] = DEFAULT_ISOLATION_LEVEL):
-        self.connector = sqlite3.connect(fp, isolation_level=isolation_level)
-        self.connector.row_factory = sqlite3.Row
+    def __init__(self, fp: str, isolation_level: typing.Optional[str] = DEFAULT_ISOLATION_LEVEL,
+                 cached_statements: int = DEFAULT_CACHED_STATEMENTS, dict_rows: bool = True,
+                 pragmas: typing.Optional[dict] = None):
+        self.connector = sqlite3.connect(fp, isolation_level=isolation_level,
+                                         cached_statements=cached_statements, check_same_thread=False)
+        # fetch() and fetchone() build their dicts from plain tuples. The sqlite3.Row factory
+        # is only for callers using the cursor directly; pass dict_rows=False to skip it.
+        if dict_rows:
+            self.connector.row_factory = sqlite3.Row
         self.cursor = self.connector.cursor()
+        # Bound methods of the cursor and connection, used by the helpers below
+        self._execute = self.cursor.execute
+        self._executemany = self.cursor.executemany
+        self._fetchmany = self.cursor.fetchmany
+        self._commit = self.connector.commit
+        if pragmas is None:
+            pragmas = FILE_PRAGMAS if fp not in (':memory:', '') else {}
+        for name, value in pragmas.items():
+            self.cursor.execute(f'PRAGMA {name}={value}')
+        # Number of rows fetch() reads at a time. When None, fetch() uses the cursor's
+        # arraysize if the caller has set it, and otherwise sizes this to the limit.
+        self.fetch_arraysize: typing.Optional[int] = None
+        # fetchone() results: (table, params) -> (expiry time, row). Off, unless enabled.
+        self._cache: typing.Dict[tuple, tuple] = {}
+        self._cache_ttl: float = 0
         # Need sqlite 3.25.x or higher for upserts
         self.upserts_supported: bool = (sqlite3.sqlite_version >= "3.25.0")
 
+    def enable_cache(self, ttl: float):
+        """
+        Caches the results of fetchone() for up to $ttl seconds. Any command run through
+        this DB instance (including all inserts, updates and deletes) clears the cache.
+        Changes made by other connections are not seen until a cached result expires.
+        @param ttl: Seconds to keep results for. Zero disables the cache.
+        """
+        self._cache_ttl = ttl
+        self._cache.clear()
+
     def run(self, cmd: str, *args):
         """
         Runs an SQLITE command in a cursor, but does not commit changes to disk
         @param cmd: The command to run
         @param args: Optional interpolated arguments
         """
-        self.cursor.execute(cmd, args)
+        if self._cache:
+            self._cache.clear()
+        self._execute(cmd, args)
 
     def runc(self, cmd: str, *args):
         """
@@ -52,8 +144,10 @@ class DB:
         @param cmd: The command to run
         @param args: Optional interpolated arguments
         """
-        self.cursor.execute(cmd, args)
-        self.connector.commit()
+        if self._cache:
+            self._cache.clear()
+        self._execute(cmd, args)
+        self._commit()
 
     def delete(self, table: str, **target):
         """
@@ -63,11 +157,9 @@ class DB:
         """
         if not target:
             raise AsfpyDBError("DELETE must have at least one defined target value for locating where to delete from")
-        items = target.items()  # Use the same ordering for keys/values
-        search = " AND ".join("`%s` = ?" % uk for uk, uv in items)
-        values = [uv for uk, uv in items]
-        statement = f'DELETE FROM {table} WHERE {search}'
-        self.runc(statement, *values)
+        cols = tuple(sorted(target))
+        statement = _build_stmt('delete', table, cols)
+        self.runc(statement, *[target[col] for col in cols])
 
     def update(self, table: str, document: dict, **target):
         """
@@ -82,10 +174,9 @@ class DB:
         if not target:
             raise AsfpyDBError("UPDATE must have at one defined target to specify the row to update")
         k, v = next(iter(target.items()))
-        items = document.items()  # Use the same ordering for keys/values
-        columns = ", ".join("%s = ?" % uk for uk, uv in items)
-        statement = f'UPDATE {table} SET {columns} WHERE {k} = ?;'
-        values = [uv for uk, uv in items]
+        cols = tuple(sorted(document))
+        statement = _build_stmt('update', table, cols, k)
+        values = [document[col] for col in cols]
         values.append(v)  # unique constraint
         self.runc(statement, *values)
 
@@ -95,12 +186,38 @@ class DB:
         @param table: The table to insert the row into
         @param document: The row data, as a dict, to insert.
         """
-        items = document.items()  # Use the same ordering for keys/values
-        columns = ", ".join("`%s`" % uk for uk, uv in items)
-        questionmarks = ", ".join(['?'] * len(items))
-        statement = f'INSERT INTO {table} ({columns}) VALUES ({questionmarks});'
-        values = [uv for uk, uv in items]
-        self.runc(statement, *values)
+        cols = tuple(sorted(document))
+        statement = _build_stmt('insert', table, cols)
+        self.runc(statement, *[document[col] for col in cols])
+
+    def insert_many(self, table: str, documents: typing.List[dict]):
+        """
+        Inserts rows into a table, in a single transaction. If the caller already has a
+        transaction open, the rows are inserted within it, and it is left open.
+        @param table: The table to insert the rows into
+        @param documents: The rows, as dicts, to insert. They must all have the same keys.
+        @raise AsfpyDBError: If the documents do not all have the same keys. Nothing is inserted.
+        """
+        if not documents:
+            return
+        cols = tuple(sorted(documents[0]))
+        for document in documents:
+            if document.keys() != documents[0].keys():
+                raise AsfpyDBError(f"insert_many documents must all have the same keys: {sorted(document)} vs {list(cols)}")
+        statement = _build_stmt('insert', table, cols)
+        self._cache.clear()
+        # Only commit (or roll back) a transaction started here
+        own_transaction = not self.connector.in_transaction
+        if own_transaction and self.connector.isolation_level is None:
+            self._execute('BEGIN')  # Else, every row is its own transaction
+        try:
+            self._executemany(statement, ([document[col] for col in cols] for document in documents))
+        except BaseException:
+            if own_transaction:
+                self.connector.rollback()
+            raise
+        if own_transaction:
+            self._commit()
 
     def upsert(self, table: str, document: dict, **target):
         """
@@ -120,14 +237,10 @@ class DB:
         # baz: 2
         # INSERT INTO foo (bar,baz) VALUES (?,?) ON CONFLICT (bar) DO UPDATE SET (bar=?, foo=?) WHERE bar=?,(1,2,1,2,1,)
         if self.upserts_supported:
-            items = document.items()  # Use the same ordering for keys/values
-            variables = ", ".join("`%s`" % uk for uk, uv in items)
-            questionmarks = ", ".join(['?'] * len(items))
-            upserts = ", ".join("`%s` = ?" % uk for uk, uv in items)
-
-            statement = f'INSERT INTO {table} ({variables}) VALUES ({questionmarks}) ON CONFLICT({k}) DO UPDATE SET {upserts} WHERE {k} = ?;'
+            cols = tuple(sorted(document))
+            statement = _build_stmt('upsert', table, cols, k)
             # insert values, update values, and the unique constraint value
-            values = ([uv for uk, uv in items] * 2) + [v]
+            values = ([document[col] for col in cols] * 2) + [v]
             self.runc(statement, *values)
         # Older versions of sqlite do not support 'ON CONFLICT', so we'll have to work around that...
         else:
@@ -145,24 +258,27 @@ class DB:
         @param params: Search parameters as key/value pairs
         @return: An iterator with all the found rows as dicts
         """
-        if params:
-            items = params.items()  # Use the same ordering for keys/values
-            search = " AND ".join("`%s` = ?" % uk for uk, uv in items)
-            values = [uv for uk, uv in items]
-        else:
-            search = "1"
-            values = []
-        statement = f'SELECT * FROM {table} WHERE {search}'
+        cols = tuple(sorted(params))
+        values = [params[col] for col in cols]
         if limit:
-            statement += f' LIMIT {limit}'
+            statement = _build_stmt('select_limit', table, cols)
+            values.append(limit)
             rows_left = limit
-        self.cursor.execute(statement, values)
+        else:
+            statement = _build_stmt('select', table, cols)
+        self._execute(statement, values)
+        # Note: the cursor is shared, so leave its arraysize alone. (Its default is 1.)
+        size = self.fetch_arraysize or self.cursor.arraysize
+        if size == 1:
+            size = min(limit or MAX_FETCH_ARRAYSIZE, MAX_FETCH_ARRAYSIZE)
+        # All rows share the column names; zip them, rather than look up each by name
+        cols = tuple(d[0] for d in self.cursor.description)
         while True:
-            rowset = self.cursor.fetchmany()
+            rowset = self._fetchmany(size)
             if not rowset:
                 return  # break iteration
             for row in rowset:
-                yield dict(row)
+                yield dict(zip(cols, row))
             if limit:
                 rows_left -= len(rowset)
                 assert rows_left >= 0
@@ -176,10 +292,24 @@ class DB:
         @param params: Search parameters as key/value pairs
         @return: If a match was found, returns the matching row as a dict, else None
         """
-        try:
-            return next(self.fetch(table_name, **params))
-        except StopIteration:  # No more entries!
-            return None
+        if self._cache_ttl:
+            key = (table_name, tuple(sorted(params.items())))
+            cached = self._cache.get(key)
+            if cached and cached[0] > time.monotonic():
+                row = cached[1]
+                return row and dict(row)  # A copy, so the caller cannot alter the cached row
+        # Rather than the generator of fetch(), run the LIMIT 1 query and fetch its row directly
+        cols = tuple(sorted(params))
+        statement = _build_stmt('select_limit', table_name, cols)
+        self._execute(statement, [params[col] for col in cols] + [1])
+        row = self.cursor.fetchone()
+        if row is not None:
+            row = dict(zip([d[0] for d in self.cursor.description], row))
+        if self._cache_ttl:
+            if len(self._cache) >= MAX_CACHED_ROWS:
+                self._cache.clear()
+            self._cache[key] = (time.monotonic() + self._cache_ttl, row and dict(row))
+        return row
 
     def table_exists(self, table: str) -> bool:
         """
@@ -190,8 +320,8 @@ class DB:
         return self.fetchone('sqlite_master', type='table', name=table) and True or False
 
 
-def test(dbname=':memory:'):
-    testdb = db(dbname)
+def test(dbname=':memory:', dict_rows=True):
+    testdb = db(dbname, dict_rows=dict_rows)
     cstatement = '''CREATE TABLE test (
                       foo   varchar unique,
                       bar   varchar,
@@ -239,8 +369,20 @@ def test(dbname=':memory:'):
     assert not testdb.table_exists('test2')
 
     # Let's insert 1000 rows, and perform a repeated fetch.
-    for i in range(1000):
-        testdb.insert('test', {'foo': str(i), 'bar': str(i), 'baz': i})
+    try:
+        testdb.insert_many('test', [{'foo': 'a'}, {'foo': 'b', 'bar': 'c'}])
+    except AsfpyDBError as e:
+        assert str(e) == "insert_many documents must all have the same keys: ['bar', 'foo'] vs ['foo']"
+    else:
+        raise AssertionError("insert_many must refuse documents with differing keys")
+    assert not testdb.fetchone('test', foo='a')
+    # Within the caller's transaction, which is left open
+    testdb.run('BEGIN')
+    testdb.insert_many('test', [{'foo': 'a'}, {'foo': 'b'}])
+    assert testdb.connector.in_transaction
+    testdb.connector.rollback()
+    assert not testdb.fetchone('test', foo='a')
+    testdb.insert_many('test', [{'foo': str(i), 'bar': str(i), 'baz': i} for i in range(1000)])
     count = 0
     for row in testdb.fetch('test', limit=None):
         assert int(row['foo']) == count
@@ -254,6 +396,15 @@ def test(dbname=':memory:'):
         assert int(row['foo']) == count
         count += 1
     assert count == 1000
+    assert testdb.cursor.arraysize == 97
+
+    # And with fetch_arraysize, which takes precedence.
+    testdb.fetch_arraysize = 89
+    count = 0
+    for row in testdb.fetch('test', limit=None):
+        assert int(row['foo']) == count
+        count += 1
+    assert count == 1000
 
     # One more run, with a limit. Leave the arraysize.
     count = 0
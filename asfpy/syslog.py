@@ -39,9 +39,22 @@ class Printer:
             log_options += syslog.LOG_PID
         syslog.openlog(log_ident, logoption=log_options, facility=facility)
 
+    @property
+    def copy_to_stdout(self):
+        return self._emit == self._emit_both
+
+    @copy_to_stdout.setter
+    def copy_to_stdout(self, value):
+        # Pick the emitter now, rather than testing the option per line.
+        self._emit = self._emit_both if value else self._emit_syslog
+
     def __call__(self, *args, **kwargs):
-        line = ' '.join([str(arg) for arg in args])
-        syslog.syslog(line)
-        if self.copy_to_stdout:
-            print(*args)
+        self._emit(args)
+
+    def _emit_syslog(self, args):
+        syslog.syslog(' '.join(map(str, args)))
+
+    def _emit_both(self, args):
+        syslog.syslog(' '.join(map(str, args)))
+        print(*args)
 
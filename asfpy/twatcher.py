@@ -30,12 +30,18 @@
 #
 
 import logging
+import asyncio
+import os.path
 
 import ezt
 import asyncinotify
 
 LOGGER = logging.getLogger(__name__)
 
+# Saving a file may produce several events (for instance: truncate, then
+# write). Wait this many seconds for the rest, to reparse the file once.
+COALESCE_DELAY = 0.1
+
 
 class TemplateWatcher:
 
@@ -43,6 +49,13 @@ class TemplateWatcher:
         # PATH : (ezt.Template, BASE_FORMAT)
         self.templates = { }
 
+        # Each directory holding templates is watched (rather than each
+        # template file), as inotify watches are a limited resource.
+        # DIRECTORY : asyncinotify.Watch
+        self.watches = { }
+        # (str(WATCH.path), BASENAME) : PATH
+        self.names = { }
+
         self.inotify = asyncinotify.Inotify()
 
     def load_template(self, path, **kwargs):
@@ -59,23 +72,49 @@ class TemplateWatcher:
         bf = kwargs.get('base_format', ezt.FORMAT_RAW)
 
         # Use str(path) in case PATH is a pathlib.Path instance.
-        self.templates[str(path)] = (t, bf)
-
-        self.inotify.add_watch(path,
-                               asyncinotify.Mask.MODIFY
-                               | asyncinotify.Mask.MASK_CREATE)
+        path = str(path)
+        self.templates[path] = (t, bf)
+
+        # Note: MOVED_TO catches editors which save by renaming a new
+        # file over the template.
+        dirname = os.path.dirname(os.path.abspath(path))
+        watch = self.watches.get(dirname)
+        if watch is None:
+            watch = self.watches[dirname] = self.inotify.add_watch(
+                dirname,
+                asyncinotify.Mask.MODIFY
+                | asyncinotify.Mask.MOVED_TO
+                | asyncinotify.Mask.MASK_CREATE)
+        self.names[str(watch.path), os.path.basename(path)] = path
         return t
 
+    def template_path(self, event):
+        "Return the path of the template changed by EVENT, or None."
+        if event.watch is None or event.name is None:
+            return None
+        return self.names.get((str(event.watch.path), str(event.name)))
+
     async def watch_forever(self):
         with self.inotify:
+            # Iterating (synchronously) yields just the pending events.
+            self.inotify.sync_timeout = 0
+
             async for event in self.inotify:
-                path = str(event.path)
-                LOGGER.info(f'Template changed: {path}')
-                #print(event)
+                await asyncio.sleep(COALESCE_DELAY)
+                # Other files in the directories are not templates.
+                paths = { self.template_path(e) for e in (event, *self.inotify) }
+                paths.discard(None)
+
+                for path in paths:
+                    LOGGER.info(f'Template changed: {path}')
 
-                # Reparse the file.
-                t, bf = self.templates[path]
-                t.parse_file(path, bf)
+                    # Reparse the file. It may be mid-write (or gone), so
+                    # keep watching; the next event will reparse it.
+                    t, bf = self.templates[path]
+                    try:
+                        t.parse_file(path, bf)
+                    except (OSError, ezt.EZTException) as e:
+                        LOGGER.error(f'Could not parse {path}: {e}')
 
 
 def test_watcher(fnames):
@@ -83,7 +122,6 @@ def test_watcher(fnames):
     tw = TemplateWatcher()
     for path in fnames:
         _ = tw.load_template(path)
-    import asyncio
     asyncio.run(tw.watch_forever())
 
 
@@ -16,30 +16,40 @@
 # limitations under the License.
 
 import socket
+import functools
+
+# The canonical name does not change while we run, and the lookup can block
+# (DNS), so it is only done once. A failed lookup raises, and so is not
+# cached; the next call tries again.
+@functools.lru_cache(maxsize=1)
+def _canonical_name():
+    """Returns the canonical name of the box, or raises LookupError if there is none"""
+    # Get local hostname (what you see in the terminal)
+    local_hostname = socket.gethostname()
+    # Get all address info segments for the local host
+    canonical_names = [
+        address[3]
+        for address in socket.getaddrinfo(local_hostname, None, 0, socket.SOCK_DGRAM, 0, socket.AI_CANONNAME)
+        if address[3]
+    ]
+    # For each canonical name, see if we find $local_hostname.something.tld, and if so, return that.
+    prefix = str(local_hostname) + "."
+    for name in canonical_names:
+        if name.startswith(prefix):
+            return name
+    if canonical_names:
+        # No match, just return the first occurrence.
+        return canonical_names[0]
+    raise LookupError(f"No canonical name for {local_hostname}")
+
 
 def whoami():
     """Returns the FQDN of the box the program runs on"""
     try:
-        # Get local hostname (what you see in the terminal)
-        local_hostname = socket.gethostname()
-        # Get all address info segments for the local host
-        canonical_names = [
-            address[3]
-            for address in socket.getaddrinfo(local_hostname, None, 0, socket.SOCK_DGRAM, 0, socket.AI_CANONNAME)
-            if address[3]
-        ]
-        # For each canonical name, see if we find $local_hostname.something.tld, and if so, return that.
-        if canonical_names:
-            prefix = str(local_hostname) + "."
-            for name in canonical_names:
-                if name.startswith(prefix):
-                    return name
-            # No match, just return the first occurrence.
-            return canonical_names[0]
-    except socket.error:
-        pass
-    # Fall back to socket.getfqdn
-    return socket.getfqdn()
+        return _canonical_name()
+    except (socket.error, LookupError):
+        # Fall back to socket.getfqdn
+        return socket.getfqdn()
 
 if __name__ == "__main__":
     print(whoami())
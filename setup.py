@@ -29,16 +29,18 @@ def main():
         author_email='users@infra.apache.org',
         license='Apache',
         packages=['asfpy'],
+        python_requires='>=3.7',
         install_requires=[
             'requests',
             'ezt',
-            'requests',
             'aiohttp',
-            'asyncinotify',
+            # inotify is Linux-only; only twatcher uses it.
+            'asyncinotify; sys_platform == "linux"',
         ],
         extras_require= {
-            'ldap': ['python-ldap'],
-            'aioldap': ['bonsai'],
+            'ldap': ['python-ldap', 'passlib'],
+            'aioldap': ['bonsai>=1.1'],
+            'pubsub': ['orjson'],
         },
         zip_safe=False)
 
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests of the connection pool of ASF_LDAPClient, with a stub connection
+# class in place of LDAP connections.
+
+import asyncio
+import logging
+import socket
+import time
+
+import pytest
+
+bonsai = pytest.importorskip('bonsai')
+import asfpy.aioldap
+
+
+class StubConnection(asfpy.aioldap.ASF_LDAPConnection):
+    "A connection which needs no server. Configured per test (see below)."
+
+    delay = 0  # seconds to block the executor thread, while connecting
+    errors = [ ]  # exceptions to raise, one for each connect
+    opened = [ ]
+
+    def __init__(self, client, executor):  # pylint: disable=super-init-not-called
+        self.executor = executor
+        self.pool = None
+        self.alive = True
+        self.closed = False
+        time.sleep(self.delay)
+        if self.errors:
+            raise self.errors.pop(0)
+        self.opened.append(self)
+
+    def close(self):
+        self.closed = True
+
+    async def whoami(self, loop=None):
+        if not self.alive:
+            raise bonsai.LDAPError('connection lost')
+        return 'dn:cn=test'
+
+
+@pytest.fixture
+def stub():
+    class Stub(StubConnection):
+        errors = [ ]
+        opened = [ ]
+    return Stub
+
+def new_client(stub, **kwargs):
+    client = asfpy.aioldap.ASF_LDAPClient('ldap://localhost', 'cn=test', 'secret', **kwargs)
+    client.CONNECTION_CLASS = stub
+    client.KEEPALIVE_INTERVAL = 0.05
+    return client
+
+async def wait_for(predicate, timeout=2):
+    "Wait until PREDICATE() is true, for the keepalive task to act."
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'timed out'
+        await asyncio.sleep(0.01)
+
+
+def test_reuse(stub):
+    client = new_client(stub, minconn=0)
+    async def main():
+        async with client.connect() as conn1:
+            assert conn1.executor is client.executor
+        async with client.connect() as conn2:
+            pass
+        return conn1, conn2
+    conn1, conn2 = asyncio.run(main())
+    assert conn1 is conn2 and stub.opened == [conn1]
+
+    # A new loop gets a new pool; the old connections are closed
+    conn3, _ = asyncio.run(main())
+    assert conn3 is not conn1 and conn1.closed
+    client.close()
+    assert conn3.closed
+
+def test_discard(stub):
+    client = new_client(stub, minconn=0)
+    async def main():
+        with pytest.raises(ValueError):
+            async with client.connect() as conn1:
+                raise ValueError('not a connection problem')
+        with pytest.raises(bonsai.errors.ConnectionError):
+            async with client.connect() as conn2:
+                raise bonsai.errors.ConnectionError('connection lost')
+        assert conn2 is conn1 and conn1.closed
+        assert client._opened == 0
+        async with client.connect() as conn3:
+            assert conn3 is not conn1
+    asyncio.run(main())
+
+def test_maxconn(stub):
+    client = new_client(stub, minconn=0, maxconn=1)
+    async def main():
+        loop = asyncio.get_running_loop()
+        conn = await client.acquire(loop)
+        waiter = asyncio.ensure_future(client.acquire(loop))
+        await asyncio.sleep(0.05)
+        assert not waiter.done()  # all (one) connections are in use
+        # Dropping the connection frees its slot, for a new connection
+        client.release(conn, discard=True)
+        conn2 = await asyncio.wait_for(waiter, 2)
+        assert conn2 is not conn and conn.closed
+        assert client._opened == 1
+        client.release(conn2)
+    asyncio.run(main())
+
+def test_cancel_while_opening(stub):
+    client = new_client(stub, minconn=0, maxconn=1)
+    stub.delay = 0.2
+    async def main():
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(client.acquire(loop))
+        await asyncio.sleep(0.05)  # the executor thread is connecting
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert client._opened == 0
+
+        # The connection completes, with nobody to use it. It is closed.
+        await wait_for(lambda: stub.opened and stub.opened[0].closed)
+
+        # ... and the slot was released
+        stub.delay = 0
+        conn = await asyncio.wait_for(client.acquire(loop), 2)
+        assert conn is not stub.opened[0] and not conn.closed
+        client.release(conn)
+    asyncio.run(main())
+
+def test_keepalive(stub, caplog):
+    client = new_client(stub, minconn=2)
+    async def main():
+        async with client.connect():
+            pass
+        # The pool is filled to MINCONN
+        await wait_for(lambda: client._pool.qsize() == 2)
+
+        # A dead connection is dropped, and replaced
+        dead = client._pool._queue[0]
+        dead.alive = False
+        await wait_for(lambda: dead.closed and client._pool.qsize() == 2)
+
+        # Unexpected errors are logged, and the pool keeps going
+        conn = await client.acquire(asyncio.get_running_loop())
+        client.release(conn, discard=True)
+        stub.errors.append(OSError('setsockopt failed'))
+        await wait_for(lambda: not stub.errors and client._pool.qsize() == 2)
+        assert not client._keepalive_task.done()
+    with caplog.at_level(logging.INFO, logger=asfpy.aioldap.LOGGER.name):
+        asyncio.run(main())
+    assert 'Dropping pooled connection: connection lost' in caplog.text
+    assert 'setsockopt failed' in caplog.text
+    client.close()
+
+def test_connect_timeout():
+    # A server which accepts the TCP connection, but never answers
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen()
+        client = asfpy.aioldap.ASF_LDAPClient(
+            'ldap://127.0.0.1:%d' % server.getsockname()[1], 'cn=test', 'secret',
+            minconn=0, connect_timeout=0.5)
+        async def main():
+            async with client.connect():
+                pass
+        start = time.monotonic()
+        with pytest.raises(bonsai.errors.ConnectionError):
+            asyncio.run(main())
+        assert time.monotonic() - start < 5
+        client.close()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asfpy.clitools
+
+LDIF = b"""dn: cn=infrastructure,ou=project,ou=groups,dc=apache,dc=org
+cn: infrastructure
+member: uid=janedoe,ou=people,dc=apache,dc=org
+member: uid=johndoe,ou=people,dc=apache,dc=org
+
+dn: uid=janedoe,ou=people,dc=apache,dc=org
+cn:: SmFuZSBEb8Op
+
+"""
+
+def test_ldapsearch_parse():
+    results = asfpy.clitools.ldapsearch_parse(LDIF)
+    assert len(results) == 2
+    assert results[0]['cn'] == ['infrastructure']
+    assert results[0]['member'] == ['uid=janedoe,ou=people,dc=apache,dc=org',
+                                    'uid=johndoe,ou=people,dc=apache,dc=org']
+    assert results[1]['dn'] == ['uid=janedoe,ou=people,dc=apache,dc=org']
+    assert results[1]['cn'] == ['Jane Doé']  # base64-encoded value
+
+    # Older callers pass the output as a str
+    assert asfpy.clitools.ldapsearch_parse(LDIF.decode('utf-8')) == results
+
+def test_ldapsearch_iter():
+    results = asfpy.clitools.ldapsearch_iter(LDIF.splitlines(keepends=True))
+    assert list(results) == asfpy.clitools.ldapsearch_parse(LDIF)
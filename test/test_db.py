@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3
+
+import pytest
+import asfpy.db
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = asfpy.db.DB(str(tmp_path / 'test.db'))
+    db.conn.execute('CREATE TABLE t (id INTEGER, name TEXT, items TEXT, keys TEXT)')
+    db.conn.executemany('INSERT INTO t VALUES (?, ?, ?, ?)', [
+        (1, 'one', 'a,b', 'k1'),
+        (2, 'two', 'c', 'k2'),
+        (3, 'three', '', 'k3'),
+    ])
+    yield db
+    db.close()
+
+def test_row(db):
+    cursor = db.cursor_for('SELECT id, name FROM t ORDER BY id')
+    cursor.perform()
+    row = cursor.fetchone()
+    assert type(row) is asfpy.db.Row
+    assert row == {'id': 1, 'name': 'one'}
+    assert row.name == row['name'] == 'one'
+    with pytest.raises(AttributeError):
+        row.items_count
+    row.extra = 5  # attributes are set as columns
+    assert row['extra'] == 5
+    del row.extra
+    assert 'extra' not in row
+    assert not hasattr(row, '__dict__')
+
+    # The connection's own cursors construct Rows, too
+    row = db.conn.execute('SELECT name FROM t WHERE id = 2').fetchone()
+    assert type(row) is asfpy.db.Row and row.name == 'two'
+
+def test_row_dict_named_columns(db):
+    cursor = db.cursor_for('SELECT id, items, keys FROM t ORDER BY id')
+    cursor.perform()
+    row = cursor.fetchone()
+    assert type(row) is asfpy.db._ColumnsFirstRow
+    # The columns win over the dict methods of the same name
+    assert row.items == 'a,b'
+    assert row.keys == 'k1'
+    assert list(dict.items(row)) == [('id', 1), ('items', 'a,b'), ('keys', 'k1')]
+    assert row.get('id') == 1  # other methods still work
+    assert not hasattr(row, '__dict__')
+
+def test_row_factory_per_cursor(db):
+    names = db.cursor_for('SELECT name FROM t ORDER BY id')
+    ids = db.cursor_for('SELECT id, items AS description FROM t ORDER BY id')
+    names.perform()
+    ids.perform()
+    # Interleave the two queries; each keeps its own column names
+    assert names.fetchone() == {'name': 'one'}
+    assert ids.fetchone() == {'id': 1, 'description': 'a,b'}
+    assert names.fetchone() == {'name': 'two'}
+    assert [row.id for row in ids.fetchall()] == [2, 3]
+    assert names.row_factory is not ids.row_factory
+
+    # A new query on the same cursor gets the new column names
+    names.execute('SELECT id AS n FROM t WHERE id = 3')
+    assert names.fetchone() == {'n': 3}
+
+def test_borrow(db, tmp_path):
+    path = (tmp_path / 'test.db').resolve()
+    assert db.readers is None  # opened upon the first borrow()
+    with db.borrow() as conn:
+        assert conn is not db.conn
+        assert conn.execute('SELECT name FROM t WHERE id = 1').fetchone().name == 'one'
+        with pytest.raises(sqlite3.OperationalError):  # read-only
+            conn.execute("INSERT INTO t VALUES (4, 'four', '', '')")
+    assert asfpy.db._POOLS[path][0] is db.readers
+    assert db.readers.qsize() == asfpy.db.DEFAULT_READERS
+
+    # Another DB for the same file (however it is named) shares the pool
+    other = asfpy.db.DB(str(tmp_path / 'sub' / '..' / 'test.db'))
+    with other.borrow():
+        pass
+    assert other.readers is db.readers
+
+    # ... and warns when asking for other settings
+    mismatched = asfpy.db.DB(str(tmp_path / 'test.db'), readers=2)
+    with pytest.warns(RuntimeWarning, match='already has a pool'):
+        with mismatched.borrow():
+            pass
+    assert mismatched.readers is db.readers
+
+    # The pool is closed with the last DB using it
+    pool = db.readers
+    with pool.mutex:
+        conns = list(pool.queue)
+    other.close()
+    mismatched.close()
+    assert path in asfpy.db._POOLS
+    db.close()
+    assert path not in asfpy.db._POOLS
+    assert pool.empty()
+    with pytest.raises(sqlite3.ProgrammingError):  # closed
+        conns[0].execute('SELECT 1')
+
+def test_borrow_memory():
+    db = asfpy.db.DB(':memory:')
+    with db.borrow() as conn:
+        assert conn is db.conn
+    assert db.readers is None
+    db.close()
+
+@pytest.mark.parametrize('where, expected', [
+    ('id > 3', None),  # no rows
+    ('id = 2', {'id': 2, 'name': 'two'}),  # one row
+    ('id > 1', {'id': 2, 'name': 'two'}),  # several rows
+])
+def test_first_row(db, where, expected):
+    cursor = db.cursor_for(f'SELECT id, name FROM t WHERE {where} ORDER BY id')
+    assert cursor.first_row() == expected
+    # The statement is finished (VACUUM fails with one in progress)
+    db.conn.execute('VACUUM')
+    if expected:
+        assert type(cursor.first_row()) is asfpy.db.Row
+
+def test_first_row_description(db):
+    # With one row, the query's description is kept
+    cursor = db.cursor_for('SELECT id, name FROM t WHERE id = ?')
+    assert cursor.first_row(1).name == 'one'
+    assert [column[0] for column in cursor.description] == ['id', 'name']
+
+def test_named_queries(tmp_path):
+    yaml_fname = tmp_path / 'queries.yaml'
+    yaml_fname.write_text('''
+queries:
+  create: CREATE TABLE t (id INTEGER, name TEXT)
+  insert: INSERT INTO t VALUES (?, ?)
+  name_for: SELECT name FROM t WHERE id = ?
+''')
+    db = asfpy.db.DB(str(tmp_path / 'test.db'), yaml_fname)
+    assert 'name_for' not in vars(db)  # created upon first use
+    db.create.perform()
+    db.insert.perform(1, 'one')
+    cursor = db.name_for
+    assert type(cursor) is asfpy.db._Cursor
+    assert db.name_for is cursor  # ... then kept as an attribute
+    assert cursor.first_row(1).name == 'one'
+    with pytest.raises(AttributeError):
+        db.missing
+    db.close()
+
+    # Query names must not clash with the attributes of DB
+    yaml_fname.write_text('queries:\n  close: SELECT 1\n')
+    with pytest.raises(Exception, match='duplicate: close'):
+        asfpy.db.DB(str(tmp_path / 'test.db'), yaml_fname)
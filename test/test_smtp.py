@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests of the SMTP conversation, against a (socket-level) fake MSA.
+
+import gc
+import smtplib
+import socketserver
+import threading
+import time
+
+import pytest
+import asfpy.messaging
+
+MSG = b'Subject: test\r\n\r\nHello\r\n.leading period\r\n'
+
+
+class FakeMSA(socketserver.ThreadingTCPServer):
+    """ An SMTP server on localhost, for use as a context manager.
+
+    With PIPELINING, the replies to MAIL and RCPT are held until DATA,
+    as RFC 2920 allows. A client which waits for each reply would hang.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, pipelining=True, refuse=(), reply_421=None,
+                 data_without_rcpt=False):
+        super().__init__(('127.0.0.1', 0), _FakeMSAHandler)
+        self.pipelining = pipelining
+        self.refuse = set(refuse)  # recipients to reject
+        self.reply_421 = reply_421  # command to answer with 421 (and hang up)
+        self.data_without_rcpt = data_without_rcpt  # 354, even with no recipients
+        self.commands = [ ]
+        self.messages = [ ]
+        self.connections = 0
+
+    @property
+    def host(self):
+        return '%s:%d' % self.server_address
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class _FakeMSAHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        pending = [ ]
+        def reply(line, hold=False):
+            pending.append(line.encode() + b'\r\n')
+            if not hold:
+                self.wfile.write(b''.join(pending))
+                pending.clear()
+        hold = server.pipelining
+
+        reply('220 fake ESMTP')
+        recipients = [ ]
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode().rstrip('\r\n')
+            verb = line[:4].upper()
+            server.commands.append(verb)
+            if verb == server.reply_421:
+                reply('421 closing connection')
+                return
+            if verb == 'EHLO':
+                if server.pipelining:
+                    reply('250-fake', hold=True)
+                    reply('250-PIPELINING', hold=True)
+                reply('250 SIZE 1000000')
+            elif verb == 'MAIL':
+                recipients = [ ]
+                reply('250 ok', hold)
+            elif verb == 'RCPT':
+                addr = line.partition(':')[2].strip('<> ')
+                if addr in server.refuse:
+                    reply('550 no such user', hold)
+                else:
+                    recipients.append(addr)
+                    reply('250 ok', hold)
+            elif verb == 'DATA':
+                if not recipients and not server.data_without_rcpt:
+                    reply('554 no valid recipients')
+                    continue
+                reply('354 go ahead')
+                body = [ ]
+                for data in self.rfile:
+                    if data == b'.\r\n':
+                        break
+                    body.append(data[1:] if data.startswith(b'.') else data)
+                if recipients:
+                    server.messages.append((recipients, b''.join(body)))
+                    reply('250 queued')
+                else:
+                    reply('554 no valid recipients')
+            elif verb == 'QUIT':
+                reply('221 bye')
+                return
+            else:  # RSET, NOOP
+                reply('250 ok')
+
+
+def connect(msa):
+    host, port = msa.server_address
+    return asfpy.messaging.PipelinedSMTP(host, port, timeout=5)
+
+def test_pipelined_accepted():
+    with FakeMSA() as msa:
+        smtp = connect(msa)
+        assert smtp.sendmail('a@example.org', ['b@example.org', 'c@example.org'], MSG) == { }
+        smtp.quit()
+    assert msa.messages == [(['b@example.org', 'c@example.org'], MSG)]
+
+def test_pipelined_some_refused():
+    with FakeMSA(refuse=['c@example.org']) as msa:
+        smtp = connect(msa)
+        senderrs = smtp.sendmail('a@example.org', ['b@example.org', 'c@example.org'], MSG)
+        assert senderrs == {'c@example.org': (550, b'no such user')}
+        smtp.quit()
+    assert msa.messages == [(['b@example.org'], MSG)]
+
+@pytest.mark.parametrize('data_without_rcpt', [False, True])
+def test_pipelined_all_refused(data_without_rcpt):
+    with FakeMSA(refuse=['b@example.org'], data_without_rcpt=data_without_rcpt) as msa:
+        smtp = connect(msa)
+        with pytest.raises(smtplib.SMTPRecipientsRefused) as excinfo:
+            smtp.sendmail('a@example.org', ['b@example.org'], MSG)
+        assert excinfo.value.recipients == {'b@example.org': (550, b'no such user')}
+
+        # the transaction was reset, and the connection is still usable
+        assert msa.commands[-1] == 'RSET'
+        smtp.sendmail('a@example.org', ['c@example.org'], MSG)
+        smtp.quit()
+    assert msa.messages == [(['c@example.org'], MSG)]
+
+def test_not_pipelined():
+    with FakeMSA(pipelining=False, refuse=['c@example.org']) as msa:
+        smtp = connect(msa)
+        senderrs = smtp.sendmail('a@example.org', ['b@example.org', 'c@example.org'], MSG)
+        assert senderrs == {'c@example.org': (550, b'no such user')}
+        smtp.quit()
+    assert msa.messages == [(['b@example.org'], MSG)]
+
+@pytest.mark.parametrize('verb, error', [
+    ('MAIL', smtplib.SMTPSenderRefused),
+    ('RCPT', smtplib.SMTPRecipientsRefused),
+])
+def test_pipelined_421(verb, error):
+    with FakeMSA(reply_421=verb) as msa:
+        smtp = connect(msa)
+        with pytest.raises(error):
+            smtp.sendmail('a@example.org', ['b@example.org'], MSG)
+        assert smtp.sock is None  # closed, after the MSA said goodbye
+    assert msa.messages == [ ]
+
+
+# the fake MSA does not do TLS
+@pytest.fixture
+def no_starttls(monkeypatch):
+    monkeypatch.setattr(asfpy.messaging.PipelinedSMTP, 'starttls',
+                        lambda self, **kwargs: (220, b'ready'))
+
+def mail_args(msa, recipient='b@example.org', **kwargs):
+    return dict(host=msa.host, recipient=recipient, subject='Subject',
+                message='Test body', **kwargs)
+
+def test_session_reuse(no_starttls):
+    with FakeMSA() as msa:
+        with asfpy.messaging.SMTPSession(msa.host) as session:
+            for _ in range(3):
+                asfpy.messaging.mail(**mail_args(msa, session=session))
+        assert session.smtp is None
+    assert len(msa.messages) == 3
+    assert msa.connections == 1
+
+def test_session_connect_failure(monkeypatch):
+    closed = [ ]
+    close = asfpy.messaging.PipelinedSMTP.close
+    monkeypatch.setattr(asfpy.messaging.PipelinedSMTP, 'close',
+                        lambda self: closed.append(self) or close(self))
+    with FakeMSA() as msa:
+        session = asfpy.messaging.SMTPSession(msa.host)
+        with pytest.raises(smtplib.SMTPNotSupportedError):  # no STARTTLS
+            session.send('a@example.org', ['b@example.org'], MSG)
+    assert session.smtp is None
+    assert len(closed) == 1 and closed[0].sock is None
+
+def test_pool_max_msgs_per_conn(no_starttls):
+    with FakeMSA() as msa:
+        pool = asfpy.messaging.SMTPPool(msa.host, max_size=1, max_msgs_per_conn=2,
+                                        check_interval=None)
+        for _ in range(5):
+            asfpy.messaging.mail(**mail_args(msa, pool=pool))
+        pool.close()
+    assert len(msa.messages) == 5
+    assert msa.connections == 3
+
+def test_pool_dropped(no_starttls):
+    with FakeMSA() as msa:
+        pool = asfpy.messaging.SMTPPool(msa.host, check_interval=0.05)
+        asfpy.messaging.mail(**mail_args(msa, pool=pool))
+        time.sleep(0.1)  # the checker thread runs
+        del pool
+        gc.collect()
+        # The idle session is closed, and the checker thread ends
+        deadline = time.monotonic() + 2
+        while any(t.name == 'SMTPPool-check' for t in threading.enumerate()):
+            assert time.monotonic() < deadline, 'checker thread still running'
+            time.sleep(0.01)
+        assert msa.commands[-1] == 'QUIT'
+
+def test_mail_many(no_starttls):
+    with FakeMSA(refuse=['nobody@example.org']) as msa:
+        msgs = [
+            mail_args(msa),
+            mail_args(msa, recipient=None),  # bad arguments
+            mail_args(msa, recipient='nobody@example.org'),  # refused by the MSA
+            mail_args(msa),
+        ]
+        failures = asfpy.messaging.mail_many(msgs, msa.host, max_msgs_per_conn=1)
+    assert sorted(failures) == [1, 2]
+    assert isinstance(failures[1], AssertionError)
+    assert isinstance(failures[2], smtplib.SMTPRecipientsRefused)
+    assert len(msa.messages) == 2
+    # a new connection after each message sent; a refusal does not count
+    assert msa.connections == 2